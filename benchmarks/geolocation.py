@@ -0,0 +1,69 @@
+"""
+Nearest city lookups of the in-memory catalog against the two $near queries
+of utils.find_nearest_from_loc, on random locations across Canada. Needs a
+built database:
+python -m benchmarks.geolocation
+"""
+import argparse
+import random
+import time
+
+from weatheh import app, utils
+
+# Rough bounding box of the populated part of Canada
+LATITUDES = (42.0, 70.0)
+LONGITUDES = (-141.0, -52.0)
+
+
+def random_locations(count, seed=0):
+    r = random.Random(seed)
+    return [
+        (r.uniform(*LATITUDES), r.uniform(*LONGITUDES)) for _ in range(count)
+    ]
+
+
+def time_lookups(lookup, locations):
+    """Results of lookup on each location and the mean seconds per lookup"""
+    start = time.perf_counter()
+    results = [lookup(lat, lon) for lat, lon in locations]
+    return results, (time.perf_counter() - start) / len(locations)
+
+
+def run(count=1000, seed=0):
+    locations = random_locations(count, seed)
+
+    start = time.perf_counter()
+    catalog = app.catalog.current()
+    load_seconds = time.perf_counter() - start
+
+    mongo_results, mongo_seconds = time_lookups(
+        lambda lat, lon: utils.find_nearest_from_loc([lat, lon]), locations
+    )
+    catalog_results, catalog_seconds = time_lookups(
+        catalog.nearest_city, locations
+    )
+    same = sum(
+        1
+        for m, c in zip(mongo_results, catalog_results)
+        if (m and m["_id"]) == (c and c["_id"])
+    )
+    return {
+        "locations": count,
+        "catalogLoadSeconds": load_seconds,
+        "mongoMicroseconds": mongo_seconds * 1e6,
+        "catalogMicroseconds": catalog_seconds * 1e6,
+        "speedup": mongo_seconds / catalog_seconds,
+        # $near is planar on [lat, lon], the catalog uses great circles
+        "sameCityRatio": same / count,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--count", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    for key, value in run(args.count, args.seed).items():
+        print(f"{key}: {value:.3f}" if isinstance(value, float) else
+              f"{key}: {value}")
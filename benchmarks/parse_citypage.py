@@ -0,0 +1,315 @@
+"""
+Parse throughput of citypage.parse_citypage against the find() based parser
+it replaced, on the citypage documents of benchmarks/fixtures:
+python -m benchmarks.parse_citypage
+"""
+import argparse
+import datetime
+import glob
+import os
+import time
+
+import lxml.etree as etree
+import pytz
+
+from weatheh import citypage
+from weatheh.citypage import to_float, to_int
+
+FIXTURES = os.path.join(
+    os.path.dirname(__file__), "fixtures", "dd", "citypage_weather", "xml"
+)
+
+
+def legacy_parse(content):
+    """The find() based parser citypage.parse_citypage replaced"""
+    root = etree.fromstring(content)
+
+    timestamp_format = "%Y%m%d%H%M%S"
+    response = {
+        "warnings": [],
+        "current": {},
+        "longTerm": [],
+        "shortTerm": [],
+        "hourly": [],
+    }
+
+    # Warnings
+    for child in root.findall("warnings/event"):
+        if child.get("type", "").strip().lower() != "warning":
+            continue
+        url = root.find("warnings").get("url")
+        warning = {
+            "priority": child.get("priority", "").strip(),
+            "description": child.get("description", "").strip(),
+            "url": url
+        }
+        if warning["priority"] not in ["low", "high", "urgent"]:
+            print(warning)
+        response["warnings"].append(warning)
+
+    # Current
+    observation_datetime_utc = None
+    for child in root.findall("currentConditions/dateTime"):
+        if child.get("zone") == "UTC":
+            observation_datetime_utc = datetime.datetime.strptime(
+                child.find("timeStamp").text, timestamp_format
+            ).replace(tzinfo=pytz.UTC)
+
+    if observation_datetime_utc:
+        observation_datetime_utc = observation_datetime_utc.astimezone(
+            pytz.UTC
+        ).isoformat()
+    response["observationDatetimeUtc"] = observation_datetime_utc
+
+    current_icon_code = getattr(
+        root.find("currentConditions/iconCode"), "text", None
+    )
+    if current_icon_code:
+        response["current"]["iconClass"] = citypage.WEATHER_ICONS.get(
+            current_icon_code, {}
+        ).get("name", "we-na")
+    else:
+        response["current"]["iconClass"] = "we-na"
+
+    response["current"]["iconCode"] = to_int(current_icon_code)
+
+    current_temperature = getattr(
+        root.find("currentConditions/temperature"), "text", None
+    )
+    response["current"]["temperatureFloat"] = to_float(current_temperature)
+    response["current"]["temperature"] = to_float(
+        current_temperature, rounding=0
+    )
+
+    current_description = getattr(
+        root.find("currentConditions/condition"), "text", None
+    )
+    response["current"]["description"] = current_description
+    response["current"]["forecastPeriod"] = response["current"][
+        "description"
+    ]
+
+    current_dew_point = getattr(
+        root.find("currentConditions/dewpoint"), "text", None
+    )
+    response["current"]["dewPoint"] = to_float(current_dew_point)
+
+    current_humidex = getattr(
+        root.find("currentConditions/humidex"), "text", None
+    )
+    response["current"]["humidex"] = to_int(current_humidex)
+
+    current_pressure_kpa = getattr(
+        root.find("currentConditions/pressure"), "text", None
+    )
+    response["current"]["pressureKpa"] = to_float(current_pressure_kpa)
+
+    current_visibility_km = getattr(
+        root.find("currentConditions/visibility"), "text", None
+    )
+    response["current"]["visibilityKm"] = to_float(current_visibility_km)
+
+    current_relative_humidity = getattr(
+        root.find("currentConditions/relativeHumidity"), "text", None
+    )
+    response["current"]["relativeHumidity"] = to_int(
+        current_relative_humidity
+    )
+
+    current_wind_speed = getattr(
+        root.find("currentConditions/wind/speed"), "text", None
+    )
+    response["current"]["windSpeed"] = to_int(current_wind_speed)
+
+    current_wind_gust = getattr(
+        root.find("currentConditions/wind/gust"), "text", None
+    )
+    response["current"]["windGust"] = current_wind_gust
+
+    current_wind_direction = getattr(
+        root.find("currentConditions/wind/direction"), "text", None
+    )
+    response["current"]["windDirection"] = current_wind_direction
+
+    current_wind_bearing_degree = getattr(
+        root.find("currentConditions/wind/bearing"), "text", None
+    )
+    response["current"]["windBearingDegree"] = to_float(
+        current_wind_bearing_degree
+    )
+
+    regional_normals_summary = getattr(
+        root.find("forecastGroup/regionalNormals/textSummary"), "text", None
+    )
+    response["current"]["regionalNormalsSummary"] = regional_normals_summary
+
+    regional_normal_low, regional_normal_high = None, None
+    for normal in root.findall(
+        "forecastGroup//regionalNormals/temperature"
+    ):
+        if normal.get("class") == "high":
+            regional_normal_high = normal.text
+        if normal.get("class") == "low":
+            regional_normal_low = normal.text
+    response["current"]["regionalNormalLow"] = to_int(regional_normal_low)
+    response["current"]["regionalNormalHigh"] = to_int(regional_normal_high)
+
+    # Short and long term
+    days = [
+        "monday",
+        "lundi",
+        "tuesday",
+        "mardi",
+        "wednesday",
+        "mercredi",
+        "thursday",
+        "jeudi",
+        "friday",
+        "vendredi",
+        "saturday",
+        "samedi",
+        "sunday",
+        "dimanche"
+    ]
+    for forecast in root.findall("forecastGroup/forecast"):
+        forecast_dict = {}
+
+        period_group = forecast.find("period")
+        period = period_group.get("textForecastName")
+        forecast_dict["forecastPeriod"] = period
+
+        description = getattr(period_group, "text", None)
+        forecast_dict["description"] = description
+
+        summary = getattr(forecast.find("textSummary"), "text", None)
+        forecast_dict["summary"] = summary
+
+        cloud_precipitation = getattr(
+            forecast.find("cloudPrecip/textSummary"), "text", None
+        )
+        forecast_dict["cloudPrecipitation"] = cloud_precipitation
+
+        icon_code = getattr(
+            forecast.find("abbreviatedForecast/iconCode"), "text", None
+        )
+        forecast_dict["iconCode"] = to_int(icon_code)
+        if icon_code:
+            forecast_dict["iconClass"] = citypage.WEATHER_ICONS.get(
+                icon_code, {}
+            ).get("name", "we-na")
+        else:
+            forecast_dict["iconClass"] = "we-na"
+
+        temperature = getattr(
+            forecast.find("temperatures/temperature"), "text", None
+        )
+        forecast_dict["temperature"] = to_int(temperature)
+
+        relative_humidity = getattr(
+            forecast.find("relativeHumidity"), "text", None
+        )
+        forecast_dict["relativeHumidity"] = to_int(relative_humidity)
+
+        precipitation_summary = getattr(
+            forecast.find("precipitation/textSummary"), "text", None
+        )
+        forecast_dict["precipitationSummary"] = precipitation_summary
+
+        if any([
+            d in forecast_dict["forecastPeriod"].lower() for d in days
+        ]):
+            response["longTerm"].append(forecast_dict)
+        else:
+            response["shortTerm"].append(forecast_dict)
+
+    # Hourly
+    for hourly in root.findall("hourlyForecastGroup/hourlyForecast"):
+        hourly_dict = {}
+        datetime_utc = datetime.datetime.strptime(
+            hourly.get("dateTimeUTC"), timestamp_format
+        ).replace(tzinfo=pytz.UTC)
+        hourly_dict["datetimeUtc"] = datetime_utc.isoformat()
+        # if hourly_dict["forLocalHour"] == "0":
+        #     hourly_dict["forLocalHour"] = "00"
+
+        condition = getattr(hourly.find("condition"), "text", None)
+        hourly_dict["condition"] = condition
+
+        icon_code = getattr(hourly.find("iconCode"), "text", None)
+        if icon_code:
+            hourly_dict["iconClass"] = citypage.WEATHER_ICONS.get(
+                icon_code, {}
+            ).get("name", "we-na")
+        else:
+            hourly_dict["iconClass"] = "we-na"
+
+        temperature = getattr(hourly.find("temperature"), "text", None)
+        hourly_dict["temperature"] = to_int(temperature)
+
+        humidex = getattr(hourly.find("humidex"), "text", None)
+        hourly_dict["humidex"] = to_int(humidex)
+
+        wind_speed = getattr(hourly.find("wind/speed"), "text", None)
+        hourly_dict["windSpeed"] = to_int(wind_speed)
+
+        wind_direction = getattr(
+            hourly.find("wind/direction"), "text", None
+        )
+        hourly_dict["windDirection"] = wind_direction
+
+        response["hourly"].append(hourly_dict)
+
+    return response
+
+
+def load_fixtures(pattern="*.xml"):
+    documents = []
+    for path in sorted(glob.glob(os.path.join(FIXTURES, "*", pattern))):
+        with open(path, "rb") as f:
+            documents.append(f.read())
+    return documents
+
+
+def docs_per_second(parse, documents, duration):
+    """Parses the documents in a loop for about duration seconds"""
+    count = 0
+    start = time.perf_counter()
+    while True:
+        for document in documents:
+            parse(document)
+        count += len(documents)
+        elapsed = time.perf_counter() - start
+        if elapsed >= duration:
+            return count / elapsed
+
+
+def run(duration=2.0, pattern="*.xml"):
+    documents = load_fixtures(pattern)
+    for document in documents:
+        if citypage.parse_citypage(document) != legacy_parse(document):
+            raise AssertionError("Parsers disagree on a fixture")
+
+    results = {
+        "documents": len(documents),
+        "legacyDocsPerSecond": docs_per_second(
+            legacy_parse, documents, duration
+        ),
+        "citypageDocsPerSecond": docs_per_second(
+            citypage.parse_citypage, documents, duration
+        ),
+    }
+    results["speedup"] = (
+        results["citypageDocsPerSecond"] / results["legacyDocsPerSecond"]
+    )
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--duration", type=float, default=2.0)
+    parser.add_argument("--pattern", default="*.xml")
+    args = parser.parse_args()
+
+    for key, value in run(args.duration, args.pattern).items():
+        print(f"{key}: {value:.1f}" if isinstance(value, float) else
+              f"{key}: {value}")
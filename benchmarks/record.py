@@ -0,0 +1,71 @@
+"""
+Replaces the citypage fixtures of benchmarks/fixtures/dd with the current
+documents of dd.weather.gc.ca, for the sites already in the fixture site
+lists, or for the ones given:
+python -m benchmarks.record --code s0000635 --code s0000430
+"""
+import argparse
+import csv
+import io
+import os
+
+import requests
+
+from benchmarks.suite import DD_FIXTURES
+
+DD_HOST = "https://dd.weather.gc.ca"
+SITE_LISTS = {
+    "en": "citypage_weather/docs/site_list_en.csv",
+    "fr": "citypage_weather/docs/site_list_fr.csv",
+}
+SWOB_STATION_LIST = "observations/doc/swob-xml_station_list.csv"
+CITYPAGE = "citypage_weather/xml/{}/{}_{}.xml"
+
+
+def save(path, content):
+    path = os.path.join(DD_FIXTURES, path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(content)
+
+
+def fixture_codes():
+    with open(os.path.join(DD_FIXTURES, SITE_LISTS["en"])) as f:
+        return [row[0] for row in csv.reader(f.read().splitlines()[2:])]
+
+
+def record(codes=None, session=None):
+    """Records the site lists, SWOB station list and citypages of codes"""
+    session = session or requests.Session()
+    codes = set(codes or fixture_codes())
+
+    def get(path):
+        r = session.get(f"{DD_HOST}/{path}", timeout=30)
+        r.raise_for_status()
+        return r.content
+
+    sites = []
+    for language, path in SITE_LISTS.items():
+        lines = get(path).decode().splitlines()
+        kept = lines[:2] + [
+            line for line in lines[2:] if line.split(",")[0] in codes
+        ]
+        save(path, ("\n".join(kept) + "\n").encode())
+        if language == "en":
+            sites = list(csv.reader(io.StringIO("\n".join(kept[2:]))))
+    save(SWOB_STATION_LIST, get(SWOB_STATION_LIST))
+
+    for code, _, province, *_ in sites:
+        if province == "HEF":
+            continue
+        for language in "ef":
+            path = CITYPAGE.format(province, code, language)
+            save(path, get(path))
+            print("RECORDED", path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--code", action="append", dest="codes")
+    args = parser.parse_args()
+    record(args.codes)
@@ -0,0 +1,125 @@
+"""
+Requests per second of a running api under concurrent clients, along with
+the resident memory of its server processes. Run it once against gunicorn
+(weatheh.wsgi) and once against uvicorn (weatheh.asgi) at the same worker
+count to compare the two:
+python -m benchmarks.serving --base http://127.0.0.1:8000 --pid <master pid>
+"""
+import argparse
+import os
+import statistics
+import threading
+import time
+
+import requests
+
+DEFAULT_PATHS = [
+    "/api/forecast/search/mont",
+    "/api/forecast/search/queb",
+    "/api/forecast/coordinates/?lat=45.5&lon=-73.6",
+    "/api/forecast/coordinates/?lat=49.3&lon=-123.1",
+]
+
+
+def process_tree(pid):
+    """pid and all of its descendants, ie: a master and its workers"""
+    children = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                # The command name is in parentheses and may hold spaces
+                parent = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(parent, []).append(int(entry))
+
+    pids, pending = [], [pid]
+    while pending:
+        current = pending.pop()
+        pids.append(current)
+        pending.extend(children.get(current, []))
+    return pids
+
+
+def rss_kb(pid):
+    """Summed VmRSS of pid and its descendants"""
+    total = 0
+    for current in process_tree(pid):
+        try:
+            with open(f"/proc/{current}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1])
+        except OSError:
+            pass
+    return total
+
+
+def client(base, paths, deadline, latencies, errors):
+    session = requests.Session()
+    position = 0
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        try:
+            r = session.get(base + paths[position % len(paths)])
+            if r.status_code >= 500:
+                errors.append(r.status_code)
+        except requests.RequestException as e:
+            errors.append(e)
+        latencies.append(time.perf_counter() - start)
+        position += 1
+
+
+def run(base, paths=None, concurrency=64, seconds=10.0, pid=None):
+    paths = paths or DEFAULT_PATHS
+    latencies, errors = [], []
+    deadline = time.perf_counter() + seconds
+    threads = [
+        threading.Thread(
+            target=client,
+            args=(base, paths[i:] + paths[:i], deadline, latencies, errors),
+        )
+        for i in range(concurrency)
+    ]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    peak_rss = 0
+    while any(t.is_alive() for t in threads):
+        if pid:
+            peak_rss = max(peak_rss, rss_kb(pid))
+        time.sleep(0.5)
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "errors": len(errors),
+        "requestsPerSecond": len(latencies) / elapsed,
+        "medianMilliseconds": statistics.median(latencies) * 1e3
+        if latencies
+        else None,
+        "p99Milliseconds": latencies[int(len(latencies) * 0.99)] * 1e3
+        if latencies
+        else None,
+        "peakRssMegabytes": peak_rss / 1024 if pid else None,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--base", default="http://127.0.0.1:8000")
+    parser.add_argument("--path", action="append", dest="paths")
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--seconds", type=float, default=10.0)
+    parser.add_argument("--pid", type=int, help="server master process")
+    args = parser.parse_args()
+
+    results = run(
+        args.base, args.paths, args.concurrency, args.seconds, args.pid
+    )
+    for key, value in results.items():
+        print(f"{key}: {value:.3f}" if isinstance(value, float) else
+              f"{key}: {value}")
@@ -0,0 +1,102 @@
+"""
+Cold start of the api as gunicorn --preload runs it: the master imports
+weatheh.wsgi and builds the catalog in its on_starting hook, then forks
+workers that each answer a first search and a first location. Reports the
+time of each step and the memory of the workers, private being what a
+worker does not share with the master. Reads the database of
+WEATHEH_MONGO_URL and WEATHEH_MONGO_DB, run in a fresh interpreter:
+python -m benchmarks.startup --workers 2
+"""
+import argparse
+import importlib
+import json
+import os
+import time
+
+FIRST_REQUESTS = [
+    ("/api/forecast/search/mont", None),
+    ("/api/forecast/coordinates/", {"lat": "45.5", "lon": "-73.6"}),
+]
+
+
+def memory_kb():
+    """Rss, Pss and private memory of this process"""
+    memory = {"rss": 0, "pss": 0, "private": 0}
+    with open("/proc/self/smaps_rollup") as f:
+        for line in f:
+            name, _, value = line.partition(":")
+            if name == "Rss":
+                memory["rss"] = int(value.split()[0])
+            elif name == "Pss":
+                memory["pss"] = int(value.split()[0])
+            elif name in ("Private_Clean", "Private_Dirty"):
+                memory["private"] += int(value.split()[0])
+    return memory
+
+
+def first_requests(application):
+    from falcon import testing
+
+    client = testing.TestClient(application)
+    start = time.perf_counter()
+    for path, params in FIRST_REQUESTS:
+        response = client.simulate_get(path, params=params)
+        if response.status_code >= 500:
+            raise AssertionError(f"{path}: {response.status}")
+    return time.perf_counter() - start
+
+
+def worker(application, write_end):
+    """Answers the first requests in a forked worker, reports on a pipe"""
+    seconds = first_requests(application)
+    report = {"firstRequestsSeconds": seconds, **memory_kb()}
+    with os.fdopen(write_end, "w") as f:
+        json.dump(report, f)
+
+
+def fork_worker(application):
+    read_end, write_end = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_end)
+        try:
+            worker(application, write_end)
+        finally:
+            os._exit(0)
+    os.close(write_end)
+    with os.fdopen(read_end) as f:
+        report = f.read()
+    os.waitpid(pid, 0)
+    return json.loads(report)
+
+
+def run(workers=2):
+    start = time.perf_counter()
+    app = importlib.import_module("weatheh.app")
+    imported = time.perf_counter()
+    from weatheh import wsgi
+
+    # What the on_starting hook of supervisord/gunicorn.conf.py runs
+    app.preload()
+    preloaded = time.perf_counter()
+    master = memory_kb()
+    reports = [fork_worker(wsgi.application) for _ in range(workers)]
+    return {
+        "importSeconds": imported - start,
+        "preloadSeconds": preloaded - imported,
+        "masterRssKb": master["rss"],
+        "workers": workers,
+        "workerFirstRequestsSeconds": max(
+            r["firstRequestsSeconds"] for r in reports
+        ),
+        "workerRssKb": max(r["rss"] for r in reports),
+        "workerPssKb": max(r["pss"] for r in reports),
+        "workerPrivateKb": max(r["private"] for r in reports),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=2)
+    args = parser.parse_args()
+    print(json.dumps(run(args.workers)))
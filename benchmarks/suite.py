@@ -0,0 +1,386 @@
+"""
+Offline benchmark suite. benchmarks/fixtures/dd holds citypage documents,
+site lists and the SWOB station list in the layout of dd.weather.gc.ca,
+served by a local stand-in for it, and benchmarks/fixtures holds a sample
+of the Canadian Geographical Names. Against a local mongo, in a database of
+its own, it times:
+
+- parse: citypage documents parsed per second
+- build: each step of the database build, add_more_cities included
+- startup: cold start and memory of api workers forked from a preloaded
+  master
+- cycle: populate_forecast, cold then answered with 304s, and the listing
+  refresh of populate
+- endpoints: latency of each api route, served in process
+
+python -m benchmarks.suite --output report.json --compare previous.json
+"""
+import argparse
+import contextlib
+import datetime
+import email.utils
+import http.server
+import io
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+from benchmarks import parse_citypage
+
+FIXTURES = os.path.join(os.path.dirname(__file__), "fixtures")
+DD_FIXTURES = os.path.join(FIXTURES, "dd")
+CGN_SAMPLE = os.path.join(FIXTURES, "cgn_canada_csv_eng.csv")
+STAGES = ["parse", "build", "startup", "cycle", "endpoints"]
+
+
+class DDHandler(http.server.SimpleHTTPRequestHandler):
+    """
+    Serves the fixtures like dd.weather.gc.ca: Last-Modified on files,
+    304s on If-Modified-Since and apache style directory listings.
+    """
+
+    # Keeps connections alive like dd.weather.gc.ca, headers and body are
+    # written separately so they must not wait on delayed acks
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, directory=DD_FIXTURES, **kwargs)
+
+    def send_head(self):
+        path = self.translate_path(self.path)
+        if self.path.endswith("/") and not os.path.isdir(path):
+            # Provinces without fixtures
+            return self.list_directory(path)
+        return super().send_head()
+
+    def list_directory(self, path):
+        rows = []
+        names = os.listdir(path) if os.path.isdir(path) else []
+        for name in sorted(names):
+            modified = datetime.datetime.fromtimestamp(
+                os.path.getmtime(os.path.join(path, name)),
+                datetime.timezone.utc,
+            )
+            size = os.path.getsize(os.path.join(path, name))
+            rows.append(
+                f'<a href="{name}">{name}</a>'
+                f"   {modified:%d-%b-%Y %H:%M}  {size / 1024:.1f}K"
+            )
+        body = "<html><body><pre>\n{}\n</pre></body></html>".format(
+            "\n".join(rows)
+        ).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        return io.BytesIO(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_dd_server():
+    """Serves the fixtures on a free port, returns its base url"""
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), DDHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def use_database(mongo_url, database):
+    """
+    Points the api, populate and the processes started by the suite at an
+    empty database.
+    """
+    from weatheh import db
+
+    os.environ["WEATHEH_MONGO_URL"] = db.MONGO_URL = mongo_url
+    os.environ["WEATHEH_MONGO_DB"] = db.MONGO_DB_NAME = database
+    db.close()
+    db.client.drop_database(database)
+
+
+@contextlib.contextmanager
+def quiet(verbose=False):
+    """Silences the print logging of populate"""
+    if verbose:
+        yield
+    else:
+        with contextlib.redirect_stdout(io.StringIO()):
+            yield
+
+
+def timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+def run_parse(duration):
+    return parse_citypage.run(duration)
+
+
+def run_build(verbose=False):
+    from weatheh import populate
+
+    results = {}
+    with quiet(verbose):
+        results["stationListSeconds"], swob_stations = timed(
+            populate.get_raw_station_list
+        )
+        results["stationsAndCitiesSeconds"], _ = timed(
+            populate.populate_stations_and_cities, swob_stations
+        )
+        results["addMoreCitiesSeconds"], _ = timed(
+            populate.add_more_cities, path=CGN_SAMPLE
+        )
+        results["materializeSeconds"], _ = timed(
+            populate.materialize_city_payloads
+        )
+    return results
+
+
+def run_startup(workers):
+    """Cold start of an api worker, in a fresh interpreter"""
+    result = subprocess.run(
+        [
+            sys.executable,
+            "-m",
+            "benchmarks.startup",
+            "--workers",
+            str(workers),
+        ],
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return json.loads(result.stdout.splitlines()[-1])
+
+
+def run_cycle(verbose=False):
+    from weatheh import db, populate, utils
+
+    results = {}
+    utils.FORECAST_VALIDATORS.clear()
+    with quiet(verbose):
+        results["coldSeconds"], stats = timed(utils.populate_forecast)
+        results["coldStats"] = stats
+        results["warmSeconds"], stats = timed(utils.populate_forecast)
+        results["warmStats"] = stats
+        populate.LISTING_MODIFIED.clear()
+        results["listingSeconds"], _ = timed(
+            populate.populate_changed_forecast
+        )
+    results["forecasts"] = db.forecasts_coll.count_documents({})
+    return results
+
+
+def percentiles(seconds):
+    seconds = sorted(seconds)
+    return {
+        "requests": len(seconds),
+        "meanMicroseconds": statistics.mean(seconds) * 1e6,
+        "p50Microseconds": seconds[len(seconds) // 2] * 1e6,
+        "p90Microseconds": seconds[int(len(seconds) * 0.9)] * 1e6,
+        "p99Microseconds": seconds[int(len(seconds) * 0.99)] * 1e6,
+    }
+
+
+def run_endpoints(requests_per_case):
+    from falcon import testing
+
+    from weatheh import app, db
+
+    client = testing.TestClient(app.api)
+    cities = list(db.cities_coll.find({}, {"_id": 1, "loc": 1}))
+    city_ids = [str(c["_id"]) for c in cities]
+    authoritative = [
+        str(c["_id"])
+        for c in db.cities_coll.find({"authoritative": True}, {"_id": 1})
+    ]
+    r = random.Random(0)
+
+    def coordinates():
+        lat, lon = r.choice(cities)["loc"]
+        return {
+            "lat": f"{lat + r.uniform(-0.2, 0.2):.4f}",
+            "lon": f"{lon + r.uniform(-0.2, 0.2):.4f}",
+        }
+
+    def etag_of(path, params=None):
+        return client.simulate_get(path, params=params).headers.get("etag")
+
+    city = f"/api/forecast/city/{authoritative[0]}"
+    cases = {
+        "city": lambda: (
+            f"/api/forecast/city/{r.choice(city_ids)}", {}, {}
+        ),
+        "cityGzip": lambda: (
+            f"/api/forecast/city/{r.choice(city_ids)}",
+            {},
+            {"Accept-Encoding": "gzip"},
+        ),
+        "citySections": lambda: (
+            f"/api/forecast/city/{r.choice(city_ids)}",
+            {"sections": "current,warnings"},
+            {},
+        ),
+        "cityNotModified": lambda: (
+            city, {}, {"If-None-Match": etag_of(city)}
+        ),
+        "batch": lambda: (
+            "/api/forecast/cities/",
+            {"ids": ",".join(authoritative[:50])},
+            {},
+        ),
+        "searchPrefix": lambda: (
+            f"/api/forecast/search/{r.choice(['mont', 'toronto', 'qu'])}",
+            {},
+            {},
+        ),
+        "searchFuzzy": lambda: (
+            f"/api/forecast/search/{r.choice(['montrael', 'vancuver'])}",
+            {},
+            {},
+        ),
+        "coordinates": lambda: (
+            "/api/forecast/coordinates/", coordinates(), {}
+        ),
+        "history": lambda: (
+            f"/api/forecast/history/{r.choice(authoritative)}",
+            {"hours": "24"},
+            {},
+        ),
+    }
+
+    results = {}
+    for name, make_request in cases.items():
+        seconds = []
+        for _ in range(requests_per_case):
+            path, params, headers = make_request()
+            start = time.perf_counter()
+            response = client.simulate_get(
+                path, params=params, headers=headers
+            )
+            seconds.append(time.perf_counter() - start)
+            if response.status_code >= 500:
+                raise AssertionError(f"{name}: {response.status}")
+        results[name] = percentiles(seconds)
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(__file__),
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def flatten(results, prefix=""):
+    """Numeric leaves of a report keyed by their dotted path"""
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[prefix + key] = value
+    return flat
+
+
+def compare(baseline, report):
+    """Ratio of each metric of report over the one of baseline"""
+    before = flatten(baseline["stages"])
+    after = flatten(report["stages"])
+    for key in sorted(before.keys() & after.keys()):
+        if before[key]:
+            print(f"{key}: {before[key]:.4g} -> {after[key]:.4g} "
+                  f"({after[key] / before[key]:.2f}x)")
+
+
+def run(
+    stages=STAGES,
+    mongo_url="mongodb://localhost:27017",
+    database="weatheh_benchmark",
+    parse_duration=2.0,
+    requests_per_case=200,
+    verbose=False,
+    workers=2,
+):
+    # Read when weatheh.utils is imported
+    if "weatheh.utils" in sys.modules:
+        raise RuntimeError("weatheh.utils must be imported after the server")
+    os.environ["WEATHEH_DD_WEATHER_HOST"] = start_dd_server()
+    if set(stages) - {"parse"}:
+        use_database(mongo_url, database)
+
+    report = {
+        "commit": git_commit(),
+        "createdAt": email.utils.formatdate(usegmt=True),
+        "python": platform.python_version(),
+        "stages": {},
+    }
+    for stage in STAGES:
+        if stage not in stages:
+            continue
+        start = time.perf_counter()
+        if stage == "parse":
+            results = run_parse(parse_duration)
+        elif stage == "build":
+            results = run_build(verbose)
+        elif stage == "startup":
+            results = run_startup(workers)
+        elif stage == "cycle":
+            results = run_cycle(verbose)
+        else:
+            results = run_endpoints(requests_per_case)
+        results["stageSeconds"] = time.perf_counter() - start
+        report["stages"][stage] = results
+        print(stage, json.dumps(results, default=str), file=sys.stderr)
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--stages",
+        default=",".join(STAGES),
+        help="comma separated, build must run before the others but parse",
+    )
+    parser.add_argument("--mongo-url", default="mongodb://localhost:27017")
+    parser.add_argument("--database", default="weatheh_benchmark")
+    parser.add_argument("--parse-duration", type=float, default=2.0)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--output", default="benchmark-report.json")
+    parser.add_argument("--compare", help="previous report to compare to")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    report = run(
+        args.stages.split(","),
+        args.mongo_url,
+        args.database,
+        args.parse_duration,
+        args.requests,
+        args.verbose,
+        args.workers,
+    )
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2, default=str)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
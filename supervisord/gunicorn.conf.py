@@ -0,0 +1,16 @@
+"""
+Gunicorn settings of the api, passed by supervisord with -c. When the app
+is preloaded, the master builds the catalog once before forking the
+workers, which then share it.
+"""
+import time
+
+
+def on_starting(server):
+    if not server.cfg.preload_app:
+        return
+    from weatheh import app
+
+    start = time.time()
+    app.preload()
+    server.log.info("Preloaded the catalog in %.2fs", time.time() - start)
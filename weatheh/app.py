@@ -1,28 +1,51 @@
+import gc
 import json
-import re
 
 import falcon
-import pymongo
-import requests
 from bson import ObjectId
 from bson.errors import InvalidId
 from falcon_cors import CORS
 
-from weatheh import utils
+from weatheh import compression, db, history, metrics, utils
+from weatheh.cache import ResponseCache
+from weatheh.catalog import Catalog
 
-MONGO_DB_NAME = "weatheh"
+RESPONSE_CACHE_SIZE = 4096
+RESPONSE_CACHE_TTL = 5 * 60
+BATCH_MAX_IDS = 50
 
 cors = CORS(allow_origins_list=["http://127.0.0.1:8080"])
-api = application = falcon.API(middleware=[cors.middleware])
-session = requests.Session()
+api = application = falcon.App(
+    middleware=[cors.middleware, metrics.MetricsMiddleware()]
+)
 
-client = pymongo.MongoClient()
-db = client[MONGO_DB_NAME]
-stations_coll = db.stations
-cities_coll = db.cities
-# db.drop_collection("forecasts")
-# forecasts_coll = db.forecasts
-# db.forecasts.create_index("datetime", expireAfterSeconds=120)
+response_cache = ResponseCache(
+    generation=lambda: (
+        utils.current_generation("forecasts"),
+        utils.current_generation("catalog"),
+    ),
+    max_size=RESPONSE_CACHE_SIZE,
+    ttl=RESPONSE_CACHE_TTL,
+)
+catalog = Catalog(
+    load_cities=lambda: db.cities_coll.find({}, {"weather": 0}),
+    load_stations=lambda: db.stations_coll.find(),
+    generation=lambda: utils.current_generation("catalog"),
+)
+
+
+def preload():
+    """
+    Builds the catalog in the gunicorn master (--preload, see
+    supervisord/gunicorn.conf.py) so the workers it forks share it
+    copy-on-write instead of each building its own. The master's mongo
+    client is closed, workers open theirs when first used.
+    """
+    catalog.current()
+    db.close()
+    # Objects left so far are never collected, the collector would
+    # otherwise write to the pages the workers share
+    gc.freeze()
 
 
 # noinspection PyMethodMayBeStatic
@@ -31,90 +54,215 @@ class City:
         language = utils.process_language(req)
         error_response = {"error": "Invalid city code provided"}
         try:
-            city = cities_coll.find_one({"_id": ObjectId(city_code)})
-            if city:
-                city["weather"] = city["weather"][language]
-                resp.body = json.dumps(utils.normalize_city(city, language))
-                resp.status = falcon.HTTP_200
-            else:
-                resp.body = json.dumps(error_response)
-                resp.status = falcon.HTTP_404
+            sections = utils.process_sections(req)
+            cached = response_cache.get(
+                ("city", city_code, language, sections),
+                lambda: self.load(city_code, language, sections),
+            )
         except InvalidId:
-            resp.body = json.dumps(error_response)
+            cached = None
+
+        if cached:
+            utils.record_requests([cached["code"]])
+            utils.flush_popularity()
+            utils.send_cached(
+                req,
+                resp,
+                cached["etag"],
+                cached["lastModified"],
+                lambda: cached["body"],
+                build_gzip=(lambda: cached["gzip"])
+                if cached["gzip"]
+                else None,
+            )
+        else:
+            resp.text = json.dumps(error_response)
             resp.status = falcon.HTTP_404
 
+    def load(self, city_code, language, sections):
+        city = db.cities_coll.find_one({"_id": ObjectId(city_code)})
+        if city:
+            forecasts = utils.find_forecasts([city], language, sections)
+            etag, last_modified = utils.response_validators(
+                [city], forecasts, language, sections
+            )
+            fragments = utils.cities_fragments([city], language, forecasts)
+            return {
+                "body": utils.city_responses([city], language, forecasts)[0],
+                "gzip": None
+                if fragments is None
+                else compression.gzip_member(fragments[0]),
+                "etag": etag,
+                "lastModified": last_modified,
+                "code": city["code"],
+            }
+        return None
+
+
+# noinspection PyMethodMayBeStatic
+class Cities:
+    """Forecasts of many cities, ie: ?ids=5c3...,5c4...&lang=fr"""
+
+    def on_get(self, req, resp):
+        language = utils.process_language(req)
+        city_codes = utils.process_city_codes(req)
+        if not city_codes or len(city_codes) > BATCH_MAX_IDS:
+            resp.text = json.dumps(
+                {"error": f"Between 1 and {BATCH_MAX_IDS} ids are required"}
+            )
+            resp.status = falcon.HTTP_400
+            return
+
+        object_ids = utils.to_object_ids(city_codes)
+        found = {
+            c["_id"]: c
+            for c in db.cities_coll.find(
+                *utils.batch_cities_query(object_ids, language)
+            )
+        }
+        cities = list(found.values())
+        utils.record_requests(c["code"] for c in cities)
+        utils.flush_popularity()
+        sections = utils.process_sections(req)
+        forecasts = utils.find_forecasts(cities, language, sections)
+        etag, last_modified = utils.response_validators(
+            cities, forecasts, language, sections
+        )
+        fragments = utils.cities_fragments(cities, language, forecasts)
+
+        def build():
+            return utils.batch_response(
+                city_codes, object_ids, found, language, forecasts
+            )
+
+        def build_gzip():
+            return utils.batch_response(
+                city_codes, object_ids, found, language, forecasts, fragments
+            )
+
+        utils.send_cached(
+            req,
+            resp,
+            etag,
+            last_modified,
+            build,
+            build_gzip=None if fragments is None else build_gzip,
+        )
+
 
 # noinspection PyMethodMayBeStatic
 class Search:
     def on_get(self, req, resp, search):
         clean_search = utils.normalize_string(search)[:128]
         if len(clean_search) < 2:
-            resp.body = json.dumps([])
+            resp.text = json.dumps([])
         else:
             language = utils.process_language(req)
-            search_regex = re.compile(
-                f"^{clean_search}",
-                # re.VERBOSE | re.DOTALL | re.UNICODE | re.IGNORECASE
+            results_docs = catalog.current().search(clean_search, language)
+
+            sections = utils.process_sections(req)
+            forecasts = utils.find_forecasts(results_docs, language, sections)
+            fragments = utils.cities_fragments(
+                results_docs, language, forecasts
             )
-            cursor = cities_coll.find(
-                {
-                    f"searchIndex{language.capitalize()}": {
-                        "$regex": search_regex
-                    }
-                }
+            etag, last_modified = utils.response_validators(
+                results_docs, forecasts, language, sections
+            )
+            utils.send_cached(
+                req,
+                resp,
+                etag,
+                last_modified,
+                lambda: utils.json_array(
+                    utils.city_responses(results_docs, language, forecasts)
+                ),
+                build_gzip=None
+                if fragments is None
+                else lambda: utils.gzip_array(fragments),
             )
-            results_docs = []
-            tracker = []
-
-            for city in cursor.limit(5):
-                tracker.append(city["_id"])
-                city["weather"] = city["weather"][language]
-                results_docs.append(utils.normalize_city(city, language))
-
-            if len(results_docs) < 5:
-                for c in cities_coll.find(
-                    {"$text": {"$search": utils.normalize_string(clean_search)}}
-                ):
-                    if len(results_docs) < 5 and c["_id"] not in tracker:
-                        tracker.append(c["_id"])
-                        c["weather"] = c["weather"][language]
-                        results_docs.append(utils.normalize_city(c, language))
-
-                    if len(results_docs) == 5:
-                        break
-
-            resp.body = json.dumps(results_docs)
 
 
 # noinspection PyUnresolvedReferences,PyMethodMayBeStatic
 class GeoLocation:
     def on_get(self, req, resp):
         language = utils.process_language(req)
+        error_response = {"error": "No weather station near provided location"}
         try:
-            latitude = float(req.params.get("lat"))
-            longitude = float(req.params.get("lon"))
-            city = utils.find_nearest_from_loc([latitude, longitude])
+            latitude, longitude = utils.process_location(req)
+            city = catalog.current().nearest_city_in_cell(
+                latitude, longitude
+            )
             if city:
-                city["weather"] = city["weather"][language]
-                resp.body = json.dumps(utils.normalize_city(city, language))
-                resp.status = falcon.HTTP_200
+                utils.record_requests([city["code"]])
+                utils.flush_popularity()
+                sections = utils.process_sections(req)
+                forecasts = utils.find_forecasts([city], language, sections)
+                etag, last_modified = utils.response_validators(
+                    [city], forecasts, language, sections
+                )
+                fragments = utils.cities_fragments(
+                    [city], language, forecasts
+                )
+                utils.send_cached(
+                    req,
+                    resp,
+                    etag,
+                    last_modified,
+                    lambda: utils.city_responses(
+                        [city], language, forecasts
+                    )[0],
+                    build_gzip=None
+                    if fragments is None
+                    else lambda: compression.gzip_member(fragments[0]),
+                )
             else:
-                resp.body = json.dumps(error_response)
+                resp.text = json.dumps(error_response)
                 resp.status = falcon.HTTP_404
         except (ValueError, TypeError):
-            resp.body = json.dumps(
-                {"error": "No weather station near provided location"}
-            )
+            resp.text = json.dumps(error_response)
             resp.status = falcon.HTTP_400
 
 
+# noinspection PyMethodMayBeStatic
+class History:
+    """
+    Current conditions of a city's weather station over the last hours or
+    days, ie: ?hours=24 or ?days=30
+    """
+
+    def on_get(self, req, resp, city_code):
+        resolution, count = history.requested_range(req)
+        try:
+            city = catalog.current().cities_by_id.get(ObjectId(city_code))
+        except InvalidId:
+            city = None
+        if not city:
+            resp.text = json.dumps({"error": "Invalid city code provided"})
+            resp.status = falcon.HTTP_404
+            return
+
+        station = city["stationCode"].lower()
+        moments, query = history.series_query(station, resolution, count)
+        body = utils.to_json(
+            history.series(
+                station, resolution, moments, db.history_coll.find(query)
+            )
+        )
+        utils.send_cached(req, resp, history.etag(body), None, lambda: body)
+
+
 cities = City()
+batches = Cities()
 searches = Search()
 geo_locations = GeoLocation()
+histories = History()
 
 api.add_route("/api/forecast/city/{city_code}", cities)
+api.add_route("/api/forecast/cities/", batches)
 api.add_route("/api/forecast/search/{search}", searches)
 api.add_route("/api/forecast/coordinates/", geo_locations)
+api.add_route("/api/forecast/history/{city_code}", histories)
+api.add_route("/api/metrics", metrics.Metrics())
 
 if __name__ == "__main__":
     from werkzeug.serving import run_simple
@@ -0,0 +1,534 @@
+"""
+Native asyncio variant of the api for ASGI servers:
+uvicorn weatheh.asgi:application
+It serves the same routes and responses as weatheh.app. Mongo is read with
+the non blocking client of pymongo, so a worker keeps serving other
+requests while it waits on a query. It also streams new forecasts as
+server-sent events, /api/forecast/events/?ids=5c3...,5c4..., which only an
+event loop can hold open by the thousands. Where gunicorn serves the api,
+the events program of supervisord runs this app for the event streams.
+"""
+import asyncio
+import json
+import time
+
+import falcon
+import falcon.asgi
+from bson import ObjectId
+from bson.errors import InvalidId
+from pymongo import AsyncMongoClient, CursorType
+from pymongo.errors import PyMongoError
+
+from weatheh import compression, db, history, metrics, utils
+from weatheh.app import (
+    BATCH_MAX_IDS,
+    RESPONSE_CACHE_SIZE,
+    RESPONSE_CACHE_TTL,
+)
+from weatheh.cache import AsyncResponseCache
+from weatheh.catalog import Catalog
+
+client = AsyncMongoClient(
+    db.MONGO_URL, event_listeners=[metrics.MongoCommandListener()]
+)
+database = client[db.MONGO_DB_NAME]
+stations_coll = database.stations
+cities_coll = database.cities
+forecasts_coll = database.forecasts
+meta_coll = database.meta
+popularity_coll = database.popularity
+updates_coll = database.forecast_updates
+history_coll = database.history
+
+# Seconds between comments keeping idle event streams open, a stream closed
+# by its client is only noticed when something is sent
+EVENTS_HEARTBEAT_INTERVAL = 15
+# Seconds before tailing forecast_updates again once its cursor died
+UPDATES_RETRY_INTERVAL = 1
+
+# Read from mongo every few seconds by refresh_generations
+generations = {"forecasts": 0, "catalog": 0}
+generations_checked = 0.0
+
+response_cache = AsyncResponseCache(
+    generation=lambda: (generations["forecasts"], generations["catalog"]),
+    max_size=RESPONSE_CACHE_SIZE,
+    ttl=RESPONSE_CACHE_TTL,
+)
+# Loaded by current_catalog, never through Catalog.current
+catalog = Catalog(
+    load_cities=list,
+    load_stations=list,
+    generation=lambda: generations["catalog"],
+)
+catalog_lock = asyncio.Lock()
+
+
+async def refresh_generations():
+    global generations_checked
+    if time.time() - generations_checked > utils.GENERATION_CHECK_INTERVAL:
+        generations_checked = time.time()
+        async for doc in meta_coll.find({"_id": {"$in": list(generations)}}):
+            generations[doc["_id"]] = doc["generation"]
+
+
+async def current_catalog():
+    """
+    The CatalogIndex of the cities, rebuilt off the event loop first if they
+    changed.
+    """
+    generation = generations["catalog"]
+    if generation != catalog.loaded_generation:
+        async with catalog_lock:
+            if generation != catalog.loaded_generation:
+                cities = await cities_coll.find({}, {"weather": 0}).to_list()
+                stations = await stations_coll.find().to_list()
+                await asyncio.to_thread(catalog.build, cities, stations)
+                catalog.loaded_generation = generation
+    return catalog.index
+
+
+async def find_forecasts(cities, language, sections=None):
+    """utils.find_forecasts without blocking the event loop"""
+    query, projection = utils.forecasts_query(cities, language, sections)
+    forecasts = {
+        f["_id"]: utils.read_forecast(f, language, sections)
+        async for f in forecasts_coll.find(query, projection)
+    }
+
+    stale = [code for code, f in forecasts.items() if f["payload"] is None]
+    if stale:
+        # Saved before payloads were materialized
+        async for forecast in forecasts_coll.find(
+            {"_id": {"$in": stale}}, {f"weather.{language}": 1}
+        ):
+            forecasts[forecast["_id"]] = utils.read_forecast(
+                forecast, language, utils.WEATHER_SECTIONS
+            )
+    return forecasts
+
+
+def response_validators(cities, forecasts, language, sections=None):
+    return utils.response_validators(
+        cities,
+        forecasts,
+        language,
+        sections,
+        catalog_generation=generations["catalog"],
+    )
+
+
+class EventStream:
+    """Site codes followed by an event stream, and the ones updated since"""
+
+    def __init__(self, codes):
+        self.codes = codes
+        self.pending = set()
+        self.updated = asyncio.Event()
+
+    def notify(self, code):
+        self.pending.add(code)
+        self.updated.set()
+
+    async def wait(self, timeout):
+        """Codes updated since the last wait, none after timeout"""
+        try:
+            await asyncio.wait_for(self.updated.wait(), timeout)
+        except asyncio.TimeoutError:
+            return set()
+        self.updated.clear()
+        codes, self.pending = self.pending, set()
+        return codes
+
+
+class ForecastUpdates:
+    """
+    Fans the site codes populate publishes in forecast_updates out to the
+    event streams of this worker, through one tailable cursor whatever the
+    number of streams.
+    """
+
+    def __init__(self):
+        self.streams = {}
+        self.last_id = None
+        self.task = None
+
+    def subscribe(self, stream):
+        for code in stream.codes:
+            self.streams.setdefault(code, set()).add(stream)
+        if self.task is None:
+            self.task = asyncio.create_task(self.tail())
+
+    def unsubscribe(self, stream):
+        for code in stream.codes:
+            streams = self.streams.get(code, set())
+            streams.discard(stream)
+            if not streams:
+                self.streams.pop(code, None)
+
+    def publish(self, codes):
+        for code in codes:
+            for stream in self.streams.get(code, ()):
+                stream.notify(code)
+
+    async def tail(self):
+        while True:
+            try:
+                if self.last_id is None:
+                    # Only updates published from now on
+                    async for doc in updates_coll.find(
+                        {}, {"_id": 1}, sort=[("$natural", -1)], limit=1
+                    ):
+                        self.last_id = doc["_id"]
+                query = {}
+                if self.last_id is not None:
+                    query = {"_id": {"$gt": self.last_id}}
+                async for doc in updates_coll.find(
+                    query, cursor_type=CursorType.TAILABLE_AWAIT
+                ):
+                    self.last_id = doc["_id"]
+                    self.publish(doc["codes"])
+            except PyMongoError as e:
+                print("UPDATES", e)
+            await asyncio.sleep(UPDATES_RETRY_INTERVAL)
+
+    async def missed(self, last_event_id, codes):
+        """
+        Codes updated after the last event a client saw, with the id of
+        the latest of those updates.
+        """
+        try:
+            query = {"_id": {"$gt": ObjectId(last_event_id)}}
+        except (InvalidId, TypeError):
+            return set(), None
+        query["codes"] = {"$in": list(codes)}
+        missed, last_id = set(), None
+        async for doc in updates_coll.find(query, {"codes": 1}):
+            missed.update(doc["codes"])
+            last_id = doc["_id"]
+        return missed & codes, last_id
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+
+updates = ForecastUpdates()
+
+
+class Generations:
+    """
+    Keeps the generations current, flushes the requests counted for
+    populate and closes mongo on shutdown.
+    """
+
+    async def process_request(self, req, resp):
+        await refresh_generations()
+
+    async def process_response(self, req, resp, resource, req_succeeded):
+        updates = utils.popularity_updates()
+        if updates:
+            await popularity_coll.bulk_write(updates, ordered=False)
+
+    async def process_shutdown(self, scope, event):
+        await updates.stop()
+        await client.close()
+
+
+# noinspection PyMethodMayBeStatic
+class City:
+    async def on_get(self, req, resp, city_code):
+        language = utils.process_language(req)
+        error_response = {"error": "Invalid city code provided"}
+        try:
+            sections = utils.process_sections(req)
+            cached = await response_cache.get(
+                ("city", city_code, language, sections),
+                lambda: self.load(city_code, language, sections),
+            )
+        except InvalidId:
+            cached = None
+
+        if cached:
+            utils.record_requests([cached["code"]])
+            utils.send_cached(
+                req,
+                resp,
+                cached["etag"],
+                cached["lastModified"],
+                lambda: cached["body"],
+                build_gzip=(lambda: cached["gzip"])
+                if cached["gzip"]
+                else None,
+            )
+        else:
+            resp.text = json.dumps(error_response)
+            resp.status = falcon.HTTP_404
+
+    async def load(self, city_code, language, sections):
+        city = await cities_coll.find_one({"_id": ObjectId(city_code)})
+        if city:
+            forecasts = await find_forecasts([city], language, sections)
+            etag, last_modified = response_validators(
+                [city], forecasts, language, sections
+            )
+            fragments = utils.cities_fragments([city], language, forecasts)
+            return {
+                "body": utils.city_responses([city], language, forecasts)[0],
+                "gzip": None
+                if fragments is None
+                else compression.gzip_member(fragments[0]),
+                "etag": etag,
+                "lastModified": last_modified,
+                "code": city["code"],
+            }
+        return None
+
+
+class Events:
+    """
+    Server-sent events of the forecasts of cities, ie: ?ids=5c3...,5c4...
+    Each new forecast populate saves for one of them is sent as a forecast
+    event holding the city like /api/forecast/city/ serves it.
+    """
+
+    def __init__(self, city):
+        self.city = city
+
+    async def on_get(self, req, resp):
+        language = utils.process_language(req)
+        city_codes = utils.process_city_codes(req)
+        if not city_codes or len(city_codes) > BATCH_MAX_IDS:
+            resp.text = json.dumps(
+                {"error": f"Between 1 and {BATCH_MAX_IDS} ids are required"}
+            )
+            resp.status = falcon.HTTP_400
+            return
+
+        object_ids = utils.to_object_ids(city_codes)
+        cities = [
+            c
+            async for c in cities_coll.find(
+                {"_id": {"$in": list(object_ids.values())}}, {"code": 1}
+            )
+        ]
+        if not cities:
+            resp.text = json.dumps({"error": "Invalid city code provided"})
+            resp.status = falcon.HTTP_404
+            return
+
+        stream = EventStream({c["code"] for c in cities})
+        missed = await updates.missed(
+            req.get_header("Last-Event-ID"), stream.codes
+        )
+        resp.cache_control = ["no-cache"]
+        # Sent as they come through nginx
+        resp.set_header("X-Accel-Buffering", "no")
+        resp.sse = self.events(
+            stream, cities, language, utils.process_sections(req), missed
+        )
+
+    async def events(self, stream, cities, language, sections, missed):
+        pending, last_id = missed
+        updates.subscribe(stream)
+        try:
+            while True:
+                last_id = updates.last_id or last_id
+                if not pending:
+                    yield None
+                for city in cities:
+                    if city["code"] not in pending:
+                        continue
+                    city_code = str(city["_id"])
+                    # Streams of the city share one load of each update
+                    key = ("event", city_code, language, sections, last_id)
+                    cached = await response_cache.get(
+                        key,
+                        lambda: self.city.load(city_code, language, sections),
+                    )
+                    if cached:
+                        yield falcon.asgi.SSEvent(
+                            data=cached["body"],
+                            event="forecast",
+                            event_id=str(last_id),
+                        )
+                pending = await stream.wait(EVENTS_HEARTBEAT_INTERVAL)
+        finally:
+            updates.unsubscribe(stream)
+
+
+# noinspection PyMethodMayBeStatic
+class Cities:
+    """Forecasts of many cities, ie: ?ids=5c3...,5c4...&lang=fr"""
+
+    async def on_get(self, req, resp):
+        language = utils.process_language(req)
+        city_codes = utils.process_city_codes(req)
+        if not city_codes or len(city_codes) > BATCH_MAX_IDS:
+            resp.text = json.dumps(
+                {"error": f"Between 1 and {BATCH_MAX_IDS} ids are required"}
+            )
+            resp.status = falcon.HTTP_400
+            return
+
+        object_ids = utils.to_object_ids(city_codes)
+        found = {
+            c["_id"]: c
+            async for c in cities_coll.find(
+                *utils.batch_cities_query(object_ids, language)
+            )
+        }
+        cities = list(found.values())
+        utils.record_requests(c["code"] for c in cities)
+        sections = utils.process_sections(req)
+        forecasts = await find_forecasts(cities, language, sections)
+        etag, last_modified = response_validators(
+            cities, forecasts, language, sections
+        )
+        fragments = utils.cities_fragments(cities, language, forecasts)
+
+        def build():
+            return utils.batch_response(
+                city_codes, object_ids, found, language, forecasts
+            )
+
+        def build_gzip():
+            return utils.batch_response(
+                city_codes, object_ids, found, language, forecasts, fragments
+            )
+
+        utils.send_cached(
+            req,
+            resp,
+            etag,
+            last_modified,
+            build,
+            build_gzip=None if fragments is None else build_gzip,
+        )
+
+
+# noinspection PyMethodMayBeStatic
+class Search:
+    async def on_get(self, req, resp, search):
+        clean_search = utils.normalize_string(search)[:128]
+        if len(clean_search) < 2:
+            resp.text = json.dumps([])
+        else:
+            language = utils.process_language(req)
+            current = await current_catalog()
+            results_docs = current.search(clean_search, language)
+
+            sections = utils.process_sections(req)
+            forecasts = await find_forecasts(results_docs, language, sections)
+            fragments = utils.cities_fragments(
+                results_docs, language, forecasts
+            )
+            etag, last_modified = response_validators(
+                results_docs, forecasts, language, sections
+            )
+            utils.send_cached(
+                req,
+                resp,
+                etag,
+                last_modified,
+                lambda: utils.json_array(
+                    utils.city_responses(results_docs, language, forecasts)
+                ),
+                build_gzip=None
+                if fragments is None
+                else lambda: utils.gzip_array(fragments),
+            )
+
+
+# noinspection PyMethodMayBeStatic
+class GeoLocation:
+    async def on_get(self, req, resp):
+        language = utils.process_language(req)
+        error_response = {"error": "No weather station near provided location"}
+        try:
+            latitude, longitude = utils.process_location(req)
+        except (ValueError, TypeError):
+            resp.text = json.dumps(error_response)
+            resp.status = falcon.HTTP_400
+            return
+
+        current = await current_catalog()
+        city = current.nearest_city_in_cell(latitude, longitude)
+        if city:
+            utils.record_requests([city["code"]])
+            sections = utils.process_sections(req)
+            forecasts = await find_forecasts([city], language, sections)
+            etag, last_modified = response_validators(
+                [city], forecasts, language, sections
+            )
+            fragments = utils.cities_fragments([city], language, forecasts)
+            utils.send_cached(
+                req,
+                resp,
+                etag,
+                last_modified,
+                lambda: utils.city_responses([city], language, forecasts)[0],
+                build_gzip=None
+                if fragments is None
+                else lambda: compression.gzip_member(fragments[0]),
+            )
+        else:
+            resp.text = json.dumps(error_response)
+            resp.status = falcon.HTTP_404
+
+
+# noinspection PyMethodMayBeStatic
+class History:
+    """
+    Current conditions of a city's weather station over the last hours or
+    days, ie: ?hours=24 or ?days=30
+    """
+
+    async def on_get(self, req, resp, city_code):
+        resolution, count = history.requested_range(req)
+        current = await current_catalog()
+        try:
+            city = current.cities_by_id.get(ObjectId(city_code))
+        except InvalidId:
+            city = None
+        if not city:
+            resp.text = json.dumps({"error": "Invalid city code provided"})
+            resp.status = falcon.HTTP_404
+            return
+
+        station = city["stationCode"].lower()
+        moments, query = history.series_query(station, resolution, count)
+        docs = await history_coll.find(query).to_list()
+        body = utils.to_json(
+            history.series(station, resolution, moments, docs)
+        )
+        utils.send_cached(req, resp, history.etag(body), None, lambda: body)
+
+
+api = application = falcon.asgi.App(
+    middleware=[
+        falcon.CORSMiddleware(allow_origins="http://127.0.0.1:8080"),
+        Generations(),
+        metrics.AsyncMetricsMiddleware(),
+    ]
+)
+cities = City()
+batches = Cities()
+searches = Search()
+geo_locations = GeoLocation()
+events = Events(cities)
+histories = History()
+
+api.add_route("/api/forecast/city/{city_code}", cities)
+api.add_route("/api/forecast/cities/", batches)
+api.add_route("/api/forecast/search/{search}", searches)
+api.add_route("/api/forecast/coordinates/", geo_locations)
+api.add_route("/api/forecast/events/", events)
+api.add_route("/api/forecast/history/{city_code}", histories)
+api.add_route("/api/metrics", metrics.AsyncMetrics())
+
+if __name__ == "__main__":
+    import uvicorn
+
+    uvicorn.run("weatheh.asgi:application", port=5000, reload=True)
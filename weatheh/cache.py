@@ -0,0 +1,98 @@
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+
+
+class ResponseCache:
+    """
+    LRU cache of serialized responses kept in each worker.
+    Entries are tagged with the generation they were built from and only
+    served while it is still the current one and their ttl has not expired.
+    Concurrent misses on the same key wait for a single load.
+    """
+
+    def __init__(self, generation, max_size=4096, ttl=5 * 60):
+        self.generation = generation
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.loading = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, load):
+        """Cached value of key, calling load() once on a miss"""
+        generation = self.generation()
+        while True:
+            with self.lock:
+                entry = self.entries.get(key)
+                if (
+                    entry
+                    and entry[0] == generation
+                    and entry[1] > time.time()
+                ):
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[2]
+
+                event = self.loading.get(key)
+                if event is None:
+                    event = self.loading[key] = threading.Event()
+                    self.misses += 1
+                    break
+            # Someone else is loading it, retrying once it is done
+            event.wait()
+
+        try:
+            value = load()
+            if value is not None:
+                self.set(key, value, generation)
+            return value
+        finally:
+            with self.lock:
+                self.loading.pop(key).set()
+
+    def set(self, key, value, generation):
+        with self.lock:
+            self.entries[key] = (generation, time.time() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class AsyncResponseCache(ResponseCache):
+    """
+    ResponseCache of an asyncio worker, load() returns an awaitable.
+    Concurrent misses on the same key await a single load.
+    """
+
+    async def get(self, key, load):
+        generation = self.generation()
+        while True:
+            entry = self.entries.get(key)
+            if entry and entry[0] == generation and entry[1] > time.time():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[2]
+
+            event = self.loading.get(key)
+            if event is None:
+                event = self.loading[key] = asyncio.Event()
+                self.misses += 1
+                break
+            # Someone else is loading it, retrying once it is done
+            await event.wait()
+
+        try:
+            value = await load()
+            if value is not None:
+                self.set(key, value, generation)
+            return value
+        finally:
+            self.loading.pop(key).set()
@@ -0,0 +1,388 @@
+"""
+Read-only copy of the cities held in memory by each api worker, with the
+indexes used to answer requests without going to mongo.
+"""
+import heapq
+import math
+import threading
+import time
+from bisect import bisect_left
+
+import numpy
+
+from weatheh.cache import ResponseCache
+
+LANGUAGES = ["en", "fr"]
+EARTH_RADIUS_KM = 6371.0
+
+# Searches are at least 2 characters long. Prefixes up to 3 characters match
+# too many cities to rank on every request, their results are ranked once
+# when the index is built.
+MIN_PREFIX_LENGTH = 2
+PRECOMPUTED_PREFIX_LENGTH = 3
+
+# Locations are snapped to a grid of this many degrees, about 1km, and all
+# locations of a cell share the nearest city of its center.
+LOCATION_CELL_DEGREES = 0.01
+LOCATION_CACHE_SIZE = 65536
+
+# Least trigram similarity, shared over all trigrams, of a fuzzy match
+TRIGRAM_THRESHOLD = 0.3
+
+
+def search_rank(city, key):
+    """Authoritative cities first, then shorter names"""
+    return not city["authoritative"], len(key), key, str(city["_id"])
+
+
+class PrefixIndex:
+    """Sorted search keys of one language, matched by prefix with bisect"""
+
+    def __init__(self, cities, language, limit=5):
+        field = f"searchIndex{language.capitalize()}"
+        entries = sorted(
+            (c[field], search_rank(c, c[field]), c)
+            for c in cities
+            if c.get(field)
+        )
+        self.keys = [e[0] for e in entries]
+        self.ranks = [e[1] for e in entries]
+        self.cities = [e[2] for e in entries]
+        self.limit = limit
+        self.precomputed = {}
+
+        prefixes = {}
+        for position, key in enumerate(self.keys):
+            for length in range(
+                MIN_PREFIX_LENGTH, PRECOMPUTED_PREFIX_LENGTH + 1
+            ):
+                if len(key) >= length:
+                    prefixes.setdefault(key[:length], []).append(position)
+        for prefix, positions in prefixes.items():
+            self.precomputed[prefix] = self.top(positions, limit)
+
+    def top(self, positions, limit):
+        best = heapq.nsmallest(limit, positions, key=self.ranks.__getitem__)
+        return [self.cities[p] for p in best]
+
+    def search(self, prefix, limit=None):
+        limit = limit or self.limit
+        if limit <= self.limit and prefix in self.precomputed:
+            return self.precomputed[prefix][:limit]
+
+        start = bisect_left(self.keys, prefix)
+        end = start
+        while end < len(self.keys) and self.keys[end].startswith(prefix):
+            end += 1
+        return self.top(range(start, end), limit)
+
+
+def trigrams(text):
+    """Trigrams of each word padded like pg_trgm: "  mo", " mon", ... "al " """
+    grams = set()
+    for word in text.split():
+        padded = f"  {word} "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+class TrigramIndex:
+    """
+    Fuzzy search over the distinct search keys of one language, scored by
+    their trigram similarity (shared trigrams over all trigrams of both).
+    Posting lists are numpy arrays so shared trigrams are counted for every
+    key at once.
+    """
+
+    def __init__(self, cities, language, threshold=TRIGRAM_THRESHOLD):
+        field = f"searchIndex{language.capitalize()}"
+        by_key = {}
+        for city in cities:
+            if city.get(field):
+                by_key.setdefault(city[field], []).append(city)
+
+        self.threshold = threshold
+        self.keys = list(by_key)
+        self.key_cities = [
+            sorted(by_key[k], key=lambda c, k=k: search_rank(c, k))
+            for k in self.keys
+        ]
+        # Breaks similarity ties the same way prefix searches are ranked
+        order = sorted(
+            range(len(self.keys)),
+            key=lambda p: search_rank(self.key_cities[p][0], self.keys[p]),
+        )
+        self.tie_breaks = numpy.empty(len(self.keys), dtype=numpy.int64)
+        self.tie_breaks[order] = numpy.arange(len(self.keys))
+
+        sizes = []
+        postings = {}
+        for position, key in enumerate(self.keys):
+            grams = trigrams(key)
+            sizes.append(len(grams))
+            for gram in grams:
+                postings.setdefault(gram, []).append(position)
+        self.sizes = numpy.array(sizes, dtype=numpy.float64)
+        self.postings = {
+            g: numpy.array(p, dtype=numpy.int32) for g, p in postings.items()
+        }
+
+    def search(self, text, limit=5, exclude=()):
+        grams = trigrams(text)
+        found = [self.postings[g] for g in grams if g in self.postings]
+        if not found:
+            return []
+
+        shared = numpy.bincount(
+            numpy.concatenate(found), minlength=len(self.keys)
+        )
+        candidates = numpy.flatnonzero(
+            shared >= math.ceil(self.threshold * len(grams))
+        )
+        count = shared[candidates]
+        similarity = count / (len(grams) + self.sizes[candidates] - count)
+        keep = similarity >= self.threshold
+        candidates, similarity = candidates[keep], similarity[keep]
+
+        # Enough keys to fill the results even if some cities are excluded
+        top = limit + len(exclude)
+        if len(candidates) > top:
+            best = numpy.argpartition(-similarity, top - 1)[:top]
+            candidates, similarity = candidates[best], similarity[best]
+        ranked = candidates[
+            numpy.lexsort((self.tie_breaks[candidates], -similarity))
+        ]
+
+        results = []
+        for position in ranked:
+            for city in self.key_cities[position]:
+                if city["_id"] not in exclude:
+                    results.append(city)
+                if len(results) == limit:
+                    return results
+        return results
+
+
+def to_unit_vector(latitude, longitude):
+    lat, lon = math.radians(latitude), math.radians(longitude)
+    return (
+        math.cos(lat) * math.cos(lon),
+        math.cos(lat) * math.sin(lon),
+        math.sin(lat),
+    )
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = (
+        math.sin((lat2 - lat1) / 2) ** 2
+        + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+class SpatialIndex:
+    """
+    KD-tree of documents located by their [lat, lon] loc. Points are kept as
+    unit vectors, the straight line distance between two of them grows with
+    their great circle distance, so the nearest one is also the nearest by
+    haversine.
+    """
+
+    leaf_size = 8
+
+    def __init__(self, docs):
+        points = [(to_unit_vector(*d["loc"]), d) for d in docs]
+        self.root = self.build(points, 0)
+
+    def build(self, points, depth):
+        """
+        Nodes are either a leaf list of points, or a
+        (split value, axis, left, right) tuple.
+        """
+        if len(points) <= self.leaf_size:
+            return points
+        axis = depth % 3
+        points.sort(key=lambda p: p[0][axis])
+        middle = len(points) // 2
+        return (
+            points[middle][0][axis],
+            axis,
+            self.build(points[:middle], depth + 1),
+            self.build(points[middle:], depth + 1),
+        )
+
+    def nearest(self, latitude, longitude):
+        """Nearest document and its haversine distance in km"""
+        x, y, z = target = to_unit_vector(latitude, longitude)
+        best, best_distance = None, math.inf
+        # Nodes to visit along with the least distance they can be at
+        stack = [(self.root, 0.0)]
+        while stack:
+            node, bound = stack.pop()
+            if bound >= best_distance:
+                continue
+            if isinstance(node, list):
+                for (px, py, pz), doc in node:
+                    distance = (px - x) ** 2 + (py - y) ** 2 + (pz - z) ** 2
+                    if distance < best_distance:
+                        best, best_distance = doc, distance
+                continue
+
+            split, axis, left, right = node
+            delta = target[axis] - split
+            near, far = (left, right) if delta < 0 else (right, left)
+            stack.append((far, max(bound, delta * delta)))
+            stack.append((near, bound))
+
+        if best is None:
+            return None, None
+        return best, haversine_km(latitude, longitude, *best["loc"])
+
+
+class CatalogIndex:
+    """
+    Indexes of one load of the cities and stations, never changed once
+    built. A request reads a single one, so it can not see the indexes of
+    two loads while the catalog is rebuilt.
+    """
+
+    def __init__(
+        self,
+        cities,
+        stations,
+        cell_degrees=LOCATION_CELL_DEGREES,
+        location_cache_size=LOCATION_CACHE_SIZE,
+    ):
+        by_station = {}
+        for city in cities:
+            if city.get("stationId"):
+                by_station.setdefault(city["stationId"], []).append(city)
+
+        self.cell_degrees = cell_degrees
+        self.location_cache_size = location_cache_size
+        self.prefixes = {
+            language: PrefixIndex(cities, language) for language in LANGUAGES
+        }
+        self.trigrams = {
+            language: TrigramIndex(cities, language) for language in LANGUAGES
+        }
+        self.stations = SpatialIndex(
+            [s for s in stations if s["_id"] in by_station]
+        )
+        self.station_cities = {
+            station_id: SpatialIndex(station_cities)
+            for station_id, station_cities in by_station.items()
+        }
+        self.cities = cities
+        self.cities_by_id = {c["_id"]: c for c in cities}
+        self.locations = self.new_location_cache()
+
+    def search(self, text, language, limit=5):
+        """Cities starting with text, topped up with typo tolerant matches"""
+        results = self.search_prefix(text, language, limit)
+        if len(results) < limit:
+            results = results + self.search_similar(
+                text,
+                language,
+                limit=limit - len(results),
+                exclude={c["_id"] for c in results},
+            )
+        return results
+
+    def search_prefix(self, prefix, language, limit=5):
+        return self.prefixes[language].search(prefix, limit)
+
+    def search_similar(self, text, language, limit=5, exclude=()):
+        """Closest names by trigram similarity, tolerating typos"""
+        return self.trigrams[language].search(text, limit, exclude)
+
+    def nearest_city(self, latitude, longitude):
+        """
+        Nearest city among the ones served by the weather station nearest
+        to the location.
+        """
+        station, _ = self.stations.nearest(latitude, longitude)
+        if station is None:
+            return None
+        city, _ = self.station_cities[station["_id"]].nearest(
+            latitude, longitude
+        )
+        return city
+
+    def new_location_cache(self):
+        """Cities nearest to each grid cell, only valid for one build"""
+        return ResponseCache(
+            generation=lambda: None,
+            max_size=self.location_cache_size,
+            ttl=math.inf,
+        )
+
+    def nearest_city_in_cell(self, latitude, longitude):
+        """
+        nearest_city of the center of the grid cell holding the location,
+        cached so nearby locations share one lookup.
+        """
+        cell = (
+            round(latitude / self.cell_degrees),
+            round(longitude / self.cell_degrees),
+        )
+
+        def load():
+            city = self.nearest_city(
+                cell[0] * self.cell_degrees, cell[1] * self.cell_degrees
+            )
+            return city and city["_id"]
+
+        return self.cities_by_id.get(self.locations.get(cell, load))
+
+
+class Catalog:
+    """
+    Cities and stations loaded from mongo and indexed once, rebuilt when the
+    catalog generation changes. load_cities and load_stations return their
+    documents, generation the current catalog generation.
+    A rebuild indexes the new documents aside then swaps them in at once,
+    requests keep reading the CatalogIndex they got from current().
+    """
+
+    def __init__(
+        self,
+        load_cities,
+        load_stations,
+        generation,
+        cell_degrees=LOCATION_CELL_DEGREES,
+        location_cache_size=LOCATION_CACHE_SIZE,
+    ):
+        self.load_cities = load_cities
+        self.load_stations = load_stations
+        self.generation = generation
+        self.cell_degrees = cell_degrees
+        self.location_cache_size = location_cache_size
+        self.loaded_generation = None
+        self.lock = threading.Lock()
+        self.index = CatalogIndex([], [], cell_degrees, location_cache_size)
+
+    def current(self):
+        """The CatalogIndex of the cities, rebuilt first if they changed"""
+        generation = self.generation()
+        if generation != self.loaded_generation:
+            with self.lock:
+                if generation != self.loaded_generation:
+                    self.build(
+                        list(self.load_cities()), list(self.load_stations())
+                    )
+                    self.loaded_generation = generation
+        return self.index
+
+    def build(self, cities, stations):
+        start = time.time()
+        self.index = CatalogIndex(
+            cities, stations, self.cell_degrees, self.location_cache_size
+        )
+        print(
+            "CATALOG",
+            f"cities={len(cities)}",
+            f"stations={len(stations)}",
+            f"build={time.time() - start:.2f}s",
+        )
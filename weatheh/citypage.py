@@ -0,0 +1,262 @@
+"""
+Parser of the citypage xml documents published on dd.weather.gc.ca.
+The fields served by the api are declared in the tables below. Their paths
+are compiled once at import and the repeated groups (forecasts, hourly
+forecasts, warnings) are selected with precompiled XPath.
+"""
+import datetime
+import json
+import os
+
+import lxml.etree as etree
+import pytz
+
+TIMESTAMP_FORMAT = "%Y%m%d%H%M%S"
+
+icons_codes_path = os.path.join(os.path.dirname(__file__), "icons_codes.json")
+with open(icons_codes_path) as f:
+    WEATHER_ICONS = json.load(f)
+
+DAYS = (
+    "monday",
+    "lundi",
+    "tuesday",
+    "mardi",
+    "wednesday",
+    "mercredi",
+    "thursday",
+    "jeudi",
+    "friday",
+    "vendredi",
+    "saturday",
+    "samedi",
+    "sunday",
+    "dimanche",
+)
+
+WARNING_PRIORITIES = ("low", "high", "urgent")
+
+
+def to_int(val):
+    try:
+        return int(val)
+    except (ValueError, TypeError):
+        return val
+
+
+def to_float(val, rounding=None):
+    try:
+        if rounding is None:
+            return float(val)
+        if rounding == 0:
+            return round(float(val))
+
+        return round(float(val), rounding)
+    except (ValueError, TypeError):
+        return val
+
+
+def to_rounded(val):
+    return to_float(val, rounding=0)
+
+
+def to_icon_class(icon_code):
+    if icon_code:
+        return WEATHER_ICONS.get(icon_code, {}).get("name", "we-na")
+    return "we-na"
+
+
+def to_utc_isoformat(timestamp):
+    """
+    20190110140000 to 2019-01-10T14:00:00+00:00, hourly forecasts are
+    stamped to the minute: 201901101400.
+    """
+    t = timestamp
+    if t.isdigit() and len(t) in (12, 14):
+        return (
+            f"{t[:4]}-{t[4:6]}-{t[6:8]}"
+            f"T{t[8:10]}:{t[10:12]}:{t[12:14] or '00'}+00:00"
+        )
+    return (
+        datetime.datetime.strptime(timestamp, TIMESTAMP_FORMAT)
+        .replace(tzinfo=pytz.UTC)
+        .isoformat()
+    )
+
+
+# (response key, path relative to the document root, converter)
+CURRENT_FIELDS = (
+    ("iconClass", "currentConditions/iconCode", to_icon_class),
+    ("iconCode", "currentConditions/iconCode", to_int),
+    ("temperatureFloat", "currentConditions/temperature", to_float),
+    ("temperature", "currentConditions/temperature", to_rounded),
+    ("description", "currentConditions/condition", None),
+    ("forecastPeriod", "currentConditions/condition", None),
+    ("dewPoint", "currentConditions/dewpoint", to_float),
+    ("humidex", "currentConditions/humidex", to_int),
+    ("pressureKpa", "currentConditions/pressure", to_float),
+    ("visibilityKm", "currentConditions/visibility", to_float),
+    ("relativeHumidity", "currentConditions/relativeHumidity", to_int),
+    ("windSpeed", "currentConditions/wind/speed", to_int),
+    ("windGust", "currentConditions/wind/gust", None),
+    ("windDirection", "currentConditions/wind/direction", None),
+    ("windBearingDegree", "currentConditions/wind/bearing", to_float),
+    (
+        "regionalNormalsSummary",
+        "forecastGroup/regionalNormals/textSummary",
+        None,
+    ),
+)
+
+# (response key, path relative to a forecastGroup/forecast, converter)
+FORECAST_FIELDS = (
+    ("forecastPeriod", "period/@textForecastName", None),
+    ("description", "period", None),
+    ("summary", "textSummary", None),
+    ("cloudPrecipitation", "cloudPrecip/textSummary", None),
+    ("iconCode", "abbreviatedForecast/iconCode", to_int),
+    ("iconClass", "abbreviatedForecast/iconCode", to_icon_class),
+    ("temperature", "temperatures/temperature", to_int),
+    ("relativeHumidity", "relativeHumidity", to_int),
+    ("precipitationSummary", "precipitation/textSummary", None),
+)
+
+# (response key, path relative to a hourlyForecastGroup/hourlyForecast,
+# converter)
+HOURLY_FIELDS = (
+    ("datetimeUtc", "@dateTimeUTC", to_utc_isoformat),
+    ("condition", "condition", None),
+    ("iconClass", "iconCode", to_icon_class),
+    ("temperature", "temperature", to_int),
+    ("humidex", "humidex", to_int),
+    ("windSpeed", "wind/speed", to_int),
+    ("windDirection", "wind/direction", None),
+)
+
+
+def compile_fields(fields):
+    """
+    Splits every path of a field table once into its tags and the optional
+    attribute read on the last element.
+    """
+    compiled = []
+    for key, path, converter in fields:
+        tags = tuple(path.split("/"))
+        attribute = None
+        if tags[-1].startswith("@"):
+            tags, attribute = tags[:-1], tags[-1][1:]
+        compiled.append((key, tags, attribute, converter))
+    return tuple(compiled)
+
+
+def extract(node, fields):
+    """
+    Reads a compiled field table off node. Children are indexed by tag once
+    per element, so fields sharing a path only walk it once. Like find(), the
+    first element of a tag wins.
+    """
+    elements = {(): node}
+    children = {}
+    response = {}
+    for key, tags, attribute, converter in fields:
+        if tags in elements:
+            element = elements[tags]
+        else:
+            element = node
+            for depth in range(len(tags)):
+                parent = tags[:depth]
+                if parent not in children:
+                    # Reversed so the first child of a tag is the one kept
+                    children[parent] = {c.tag: c for c in reversed(element)}
+                element = children[parent].get(tags[depth])
+                if element is None:
+                    break
+            elements[tags] = element
+
+        if element is None:
+            value = None
+        elif attribute:
+            value = element.get(attribute)
+        else:
+            value = element.text
+        response[key] = converter(value) if converter else value
+    return response
+
+
+CURRENT_PATHS = compile_fields(CURRENT_FIELDS)
+FORECAST_PATHS = compile_fields(FORECAST_FIELDS)
+HOURLY_PATHS = compile_fields(HOURLY_FIELDS)
+
+WARNINGS_URL_XPATH = etree.XPath("warnings/@url", smart_strings=False)
+WARNING_EVENTS_XPATH = etree.XPath("warnings/event")
+OBSERVATION_XPATH = etree.XPath(
+    "currentConditions/dateTime[@zone='UTC']/timeStamp"
+)
+REGIONAL_NORMALS_XPATH = etree.XPath(
+    "forecastGroup//regionalNormals/temperature"
+)
+FORECASTS_XPATH = etree.XPath("forecastGroup/forecast")
+HOURLY_XPATH = etree.XPath("hourlyForecastGroup/hourlyForecast")
+
+
+def parse_citypage(content):
+    """Parses a citypage xml document into the forecast served by the api"""
+    root = etree.fromstring(content)
+
+    response = {
+        "warnings": [],
+        "current": {},
+        "longTerm": [],
+        "shortTerm": [],
+        "hourly": [],
+    }
+
+    # Warnings
+    warnings_url = None
+    for event in WARNING_EVENTS_XPATH(root):
+        if event.get("type", "").strip().lower() != "warning":
+            continue
+        if warnings_url is None:
+            warnings_url = next(iter(WARNINGS_URL_XPATH(root)), None)
+        warning = {
+            "priority": event.get("priority", "").strip(),
+            "description": event.get("description", "").strip(),
+            "url": warnings_url,
+        }
+        if warning["priority"] not in WARNING_PRIORITIES:
+            print(warning)
+        response["warnings"].append(warning)
+
+    # Current
+    observation_datetime_utc = None
+    for timestamp in OBSERVATION_XPATH(root):
+        observation_datetime_utc = to_utc_isoformat(timestamp.text)
+    response["observationDatetimeUtc"] = observation_datetime_utc
+
+    current = extract(root, CURRENT_PATHS)
+    regional_normal_low, regional_normal_high = None, None
+    for normal in REGIONAL_NORMALS_XPATH(root):
+        if normal.get("class") == "high":
+            regional_normal_high = normal.text
+        if normal.get("class") == "low":
+            regional_normal_low = normal.text
+    current["regionalNormalLow"] = to_int(regional_normal_low)
+    current["regionalNormalHigh"] = to_int(regional_normal_high)
+    response["current"] = current
+
+    # Short and long term
+    for forecast in FORECASTS_XPATH(root):
+        forecast_dict = extract(forecast, FORECAST_PATHS)
+        period = forecast_dict["forecastPeriod"].lower()
+        if any(d in period for d in DAYS):
+            response["longTerm"].append(forecast_dict)
+        else:
+            response["shortTerm"].append(forecast_dict)
+
+    # Hourly
+    for hourly in HOURLY_XPATH(root):
+        response["hourly"].append(
+            extract(hourly, HOURLY_PATHS)
+        )
+
+    return response
@@ -0,0 +1,141 @@
+"""
+Gzip responses assembled from fragments compressed ahead of time.
+Each fragment is a raw deflate stream flushed to a byte boundary, so
+fragments can be concatenated in any order into a single gzip member
+without compressing anything per request. Only the crc32 of the whole
+body is computed on the fly, out of the crc32 and size of each fragment.
+"""
+import struct
+import zlib
+
+# Fragments are compressed once by populate, the best ratio is worth it
+GZIP_LEVEL = 9
+
+# Magic, deflate, no flags, no mtime, no extra flags, unknown OS
+GZIP_HEADER = b"\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff"
+# Empty final block with fixed codes ending the deflate stream
+DEFLATE_END = b"\x03\x00"
+# Reversed polynomial of the crc32 of gzip and zlib
+CRC32_POLYNOMIAL = 0xEDB88320
+
+
+def deflate_fragment(data):
+    """Compressed data, its crc32 and size, as saved in mongo"""
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return {
+        "deflate": compressor.compress(data)
+        + compressor.flush(zlib.Z_SYNC_FLUSH),
+        "crc": zlib.crc32(data),
+        "size": len(data),
+    }
+
+
+def operator_tables(columns):
+    """
+    Lookup tables, one per byte of a crc32, of the GF(2) matrix with these
+    32 columns: the product with a crc is 4 lookups.
+    """
+    tables = []
+    for shift in range(0, 32, 8):
+        table = [0] * 256
+        for value in range(1, 256):
+            low = value & -value
+            table[value] = (
+                table[value ^ low] ^ columns[shift + low.bit_length() - 1]
+            )
+        tables.append(table)
+    return tables
+
+
+def apply_operator(tables, crc):
+    return (
+        tables[0][crc & 0xFF]
+        ^ tables[1][crc >> 8 & 0xFF]
+        ^ tables[2][crc >> 16 & 0xFF]
+        ^ tables[3][crc >> 24]
+    )
+
+
+def zeros_operators():
+    """
+    Tables running a crc32 over 2**k zero bytes, for every k a size fits
+    in. Each one is the square of the previous, starting from a single
+    zero bit: the crc shifts right and takes the polynomial when its low
+    bit drops out.
+    """
+    columns = [CRC32_POLYNOMIAL] + [1 << n for n in range(31)]
+    operators = []
+    for k in range(3 + 32):
+        tables = operator_tables(columns)
+        if k >= 3:
+            operators.append(tables)
+        columns = [apply_operator(tables, c) for c in columns]
+    return operators
+
+
+# crc32 of any size2 up to 4GB, shifted in 4 lookups per set bit of size2
+ZEROS_OPERATORS = zeros_operators()
+
+
+def crc32_combine(crc1, crc2, size2):
+    """
+    crc32 of a + b out of crc32(a), crc32(b) and len(b). A crc32 is affine
+    in both its initial value and its data, so appending b to a amounts to
+    running crc1 over len(b) zeros and adding what b contributes. Running
+    over the zeros is a product with the operators of the bits of len(b),
+    like zlib's crc32_combine, in time logarithmic in len(b).
+    """
+    k = 0
+    while size2:
+        if size2 & 1:
+            crc1 = apply_operator(ZEROS_OPERATORS[k], crc1)
+        size2 >>= 1
+        k += 1
+    return crc1 ^ crc2
+
+
+def gzip_member(fragments):
+    """Gzip body of the fragments, in order"""
+    crc, size = 0, 0
+    for fragment in fragments:
+        crc = crc32_combine(crc, fragment["crc"], fragment["size"])
+        size += fragment["size"]
+    return b"".join(
+        [GZIP_HEADER]
+        + [f["deflate"] for f in fragments]
+        + [DEFLATE_END, struct.pack("<II", crc, size & 0xFFFFFFFF)]
+    )
+
+
+def accepts_gzip(req):
+    """
+    Whether Accept-Encoding allows a gzip response, an explicit gzip or
+    x-gzip coding taking precedence over *.
+    """
+    qualities = {}
+    for coding in (req.get_header("Accept-Encoding") or "").split(","):
+        name, *params = coding.split(";")
+        name = name.strip().lower()
+        if name == "x-gzip":
+            name = "gzip"
+        if name not in ("gzip", "*"):
+            continue
+        quality = 1.0
+        for param in params:
+            key, _, value = param.partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[name] = max(quality, qualities.get(name, 0.0))
+    return qualities.get("gzip", qualities.get("*", 0.0)) > 0
+
+
+# JSON glue between materialized payloads
+WEATHER_KEY = deflate_fragment(b',"weather":')
+EMPTY_OBJECT = deflate_fragment(b"{}")
+CLOSE_OBJECT = deflate_fragment(b"}")
+OPEN_ARRAY = deflate_fragment(b"[")
+COMMA = deflate_fragment(b",")
+CLOSE_ARRAY = deflate_fragment(b"]")
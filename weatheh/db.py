@@ -0,0 +1,64 @@
+"""
+Mongo client, collections and requests session of the current process,
+created on first use: db.cities_coll.find(...)
+Nothing connects at import, and a forked process starts over with clients
+of its own, as pymongo clients must not be shared across a fork. A master
+preloading the api (gunicorn --preload) can read mongo then fork its
+workers safely.
+"""
+import os
+
+import pymongo
+import requests
+
+from weatheh import metrics
+
+MONGO_URL = os.environ.get("WEATHEH_MONGO_URL", "mongodb://localhost:27017")
+MONGO_DB_NAME = os.environ.get("WEATHEH_MONGO_DB", "weatheh")
+
+COLLECTIONS = {
+    "stations_coll": "stations",
+    "cities_coll": "cities",
+    "forecasts_coll": "forecasts",
+    "meta_coll": "meta",
+    "popularity_coll": "popularity",
+    "updates_coll": "forecast_updates",
+    "history_coll": "history",
+}
+
+# Created by this process, forgotten by forked children
+_process = {}
+os.register_at_fork(after_in_child=_process.clear)
+
+
+def get_client():
+    if "client" not in _process:
+        _process["client"] = pymongo.MongoClient(
+            MONGO_URL, event_listeners=[metrics.MongoCommandListener()]
+        )
+    return _process["client"]
+
+
+def get_session():
+    if "session" not in _process:
+        _process["session"] = requests.Session()
+    return _process["session"]
+
+
+def close():
+    """Closes the client of this process, the next use opens a new one"""
+    client = _process.pop("client", None)
+    if client is not None:
+        client.close()
+
+
+def __getattr__(name):
+    if name == "client":
+        return get_client()
+    if name == "database":
+        return get_client()[MONGO_DB_NAME]
+    if name in COLLECTIONS:
+        return get_client()[MONGO_DB_NAME][COLLECTIONS[name]]
+    if name == "session":
+        return get_session()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
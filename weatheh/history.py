@@ -0,0 +1,258 @@
+"""
+History of the current conditions of each weather station, for charts of
+the last hours and days. Sites sharing a station share its history.
+Documents are buckets of fixed-width columns: float32 arrays saved as
+binary, NaN where nothing was observed.
+- hourly: one day of observations, kept a week
+- daily: one month of daily means, with the low and high temperature,
+  kept a year. Downsampled from the hourly bucket each time it is written.
+Buckets expire through a TTL index on their expires date, a series is read
+in a single query on the ids of its buckets.
+"""
+import datetime
+import hashlib
+import time
+import warnings
+
+import numpy
+from bson import Binary
+from pymongo import UpdateOne
+
+from weatheh import db
+
+# Column of the history: key of the current conditions it is read from
+COLUMNS = {
+    "temperature": "temperatureFloat",
+    "pressure": "pressureKpa",
+    "humidity": "relativeHumidity",
+    "windSpeed": "windSpeed",
+    "windGust": "windGust",
+}
+# Daily columns of the hourly temperatures besides their mean
+DAILY_EXTREMES = {
+    "temperatureMin": numpy.nanmin,
+    "temperatureMax": numpy.nanmax,
+}
+DTYPE = "<f4"
+
+HOURLY = "hourly"
+DAILY = "daily"
+RESOLUTIONS = {
+    HOURLY: {
+        "slots": 24,
+        "interval": datetime.timedelta(hours=1),
+        "retention": datetime.timedelta(days=7),
+    },
+    DAILY: {
+        "slots": 31,
+        "interval": datetime.timedelta(days=1),
+        "retention": datetime.timedelta(days=366),
+    },
+}
+DEFAULT_HOURS = 24
+MAX_HOURS = 7 * 24
+MAX_DAYS = 366
+
+# Columns of the last bucket written for each (station code, resolution),
+# populate is the only writer
+_buckets = {}
+_indexes_created = False
+
+
+def column_names(resolution):
+    if resolution == DAILY:
+        return list(COLUMNS) + list(DAILY_EXTREMES)
+    return list(COLUMNS)
+
+
+def bucket_slot(resolution, moment):
+    """Start of the bucket holding moment, and the slot of moment in it"""
+    day = moment.replace(hour=0, minute=0, second=0, microsecond=0)
+    if resolution == HOURLY:
+        return day, moment.hour
+    return day.replace(day=1), moment.day - 1
+
+
+def bucket_id(station, resolution, start):
+    return f"{station}:{resolution}:{start:%Y%m%d}"
+
+
+def encode(column):
+    return Binary(column.astype(DTYPE).tobytes())
+
+
+def decode(data, resolution):
+    if data is None:
+        return numpy.full(RESOLUTIONS[resolution]["slots"], numpy.nan, DTYPE)
+    return numpy.frombuffer(data, dtype=DTYPE).copy()
+
+
+def to_value(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return numpy.nan
+
+
+def to_utc(isoformat):
+    """Naive utc datetime, as pymongo reads them, of an iso timestamp"""
+    moment = datetime.datetime.fromisoformat(isoformat)
+    return moment.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+
+
+def load_buckets(keys):
+    """Columns of the buckets (station, resolution, start), read once"""
+    missing = {
+        bucket_id(*key): key
+        for key in keys
+        if _buckets.get(key[:2], (None,))[0] != bucket_id(*key)
+    }
+    found = {
+        doc["_id"]: doc
+        for doc in db.history_coll.find({"_id": {"$in": list(missing)}})
+    }
+    for _id, (station, resolution, _) in missing.items():
+        doc = found.get(_id, {})
+        _buckets[station, resolution] = (
+            _id,
+            {
+                name: decode(doc.get(name), resolution)
+                for name in column_names(resolution)
+            },
+        )
+
+
+def bucket_update(station, resolution, start, columns):
+    settings = RESOLUTIONS[resolution]
+    end = start + settings["interval"] * settings["slots"]
+    return UpdateOne(
+        {"_id": bucket_id(station, resolution, start)},
+        {
+            "$set": {
+                **{name: encode(c) for name, c in columns.items()},
+                "expires": end + settings["retention"],
+            },
+            "$setOnInsert": {
+                "station": station,
+                "resolution": resolution,
+                "start": start,
+            },
+        },
+        upsert=True,
+    )
+
+
+def downsample(hourly, daily, day):
+    with warnings.catch_warnings():
+        # Days without any observation of a column stay NaN
+        warnings.simplefilter("ignore", RuntimeWarning)
+        for name in COLUMNS:
+            daily[name][day] = numpy.nanmean(hourly[name])
+        for name, reduce in DAILY_EXTREMES.items():
+            daily[name][day] = reduce(hourly["temperature"])
+
+
+def record(observations):
+    """
+    Saves observations, (station code, observation time in iso format,
+    current conditions), in their hourly bucket and the daily one
+    downsampled from it. Returns the time it took.
+    """
+    global _indexes_created
+    start = time.time()
+    # Sites of a station report its observations, the latest is kept
+    latest = {}
+    for station, observed, current in observations:
+        if not (station and observed):
+            continue
+        station, moment = station.lower(), to_utc(observed)
+        if station not in latest or moment > latest[station][0]:
+            latest[station] = (moment, current)
+    observations = [
+        (station, moment, current)
+        for station, (moment, current) in latest.items()
+    ]
+    if not observations:
+        return 0.0
+    if not _indexes_created:
+        db.history_coll.create_index("expires", expireAfterSeconds=0)
+        _indexes_created = True
+
+    load_buckets(
+        [
+            (station, resolution, bucket_slot(resolution, moment)[0])
+            for station, moment, _ in observations
+            for resolution in RESOLUTIONS
+        ]
+    )
+    updates = []
+    for station, moment, current in observations:
+        hourly_start, hour = bucket_slot(HOURLY, moment)
+        daily_start, day = bucket_slot(DAILY, moment)
+        _, hourly = _buckets[station, HOURLY]
+        _, daily = _buckets[station, DAILY]
+        for name, key in COLUMNS.items():
+            hourly[name][hour] = to_value(current.get(key))
+        downsample(hourly, daily, day)
+        updates.append(bucket_update(station, HOURLY, hourly_start, hourly))
+        updates.append(bucket_update(station, DAILY, daily_start, daily))
+    db.history_coll.bulk_write(updates, ordered=False)
+    return time.time() - start
+
+
+def requested_range(req):
+    """(resolution, slots) of ?hours= or ?days="""
+    days = req.get_param_as_int("days", min_value=1, max_value=MAX_DAYS)
+    if days:
+        return DAILY, days
+    hours = req.get_param_as_int("hours", min_value=1, max_value=MAX_HOURS)
+    return HOURLY, hours or DEFAULT_HOURS
+
+
+def series_query(station, resolution, count, now=None):
+    """
+    Moment of each of the count slots ending with the one of now, and the
+    query of their buckets.
+    """
+    now = now or datetime.datetime.utcnow()
+    interval = RESOLUTIONS[resolution]["interval"]
+    last = now.replace(minute=0, second=0, microsecond=0)
+    if resolution == DAILY:
+        last = last.replace(hour=0)
+    moments = [last - interval * i for i in reversed(range(count))]
+    ids = {
+        bucket_id(station, resolution, bucket_slot(resolution, m)[0])
+        for m in moments
+    }
+    return moments, {"_id": {"$in": sorted(ids)}}
+
+
+def series(station, resolution, moments, docs):
+    """Columns of the slots at moments out of their bucket documents"""
+    names = column_names(resolution)
+    buckets = {
+        doc["_id"]: {name: decode(doc.get(name), resolution) for name in names}
+        for doc in docs
+    }
+    columns = {name: [] for name in names}
+    for moment in moments:
+        start, slot = bucket_slot(resolution, moment)
+        bucket = buckets.get(bucket_id(station, resolution, start))
+        for name in names:
+            value = bucket[name][slot] if bucket else numpy.nan
+            columns[name].append(
+                None if numpy.isnan(value) else round(float(value), 1)
+            )
+    return {
+        "station": station,
+        "resolution": resolution,
+        "start": moments[0].isoformat() + "+00:00",
+        "intervalSeconds": int(
+            RESOLUTIONS[resolution]["interval"].total_seconds()
+        ),
+        **columns,
+    }
+
+
+def etag(body):
+    return f'"{hashlib.sha1(body).hexdigest()}"'
@@ -0,0 +1,506 @@
+"""
+Counters, gauges and histograms kept in memory by each process and exposed
+in the Prometheus text format: by the api on /api/metrics, by populate in a
+file written after every cycle, to be picked up by the node exporter
+textfile collector.
+Api workers each count their own requests. With WEATHEH_METRICS_DIR set,
+every worker saves its values every second, from a thread of its own, in a
+file of that directory named after its pid. /api/metrics answers the sum
+of the files and of its own values, so scrapes see the same totals
+whichever worker answers them. Files of stopped workers are
+kept, their counts still belong to the totals, the directory is to be
+emptied before the workers start.
+"""
+import atexit
+import glob
+import json
+import os
+import threading
+import time
+
+from pymongo import monitoring
+
+# Seconds, from a cached response to a full populate cycle
+DEFAULT_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+    300.0,
+)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+METRICS_DIR = os.environ.get("WEATHEH_METRICS_DIR")
+# Seconds between two saves of the values of a worker
+METRICS_WRITE_INTERVAL = 1
+
+
+def escape(value):
+    return (
+        str(value)
+        .replace("\\", r"\\")
+        .replace('"', r'\"')
+        .replace("\n", r"\n")
+    )
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{n}="{escape(v)}"' for n, v in pairs) + "}"
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """Values of a metric for each combination of its label values"""
+
+    kind = "untyped"
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def key(self, labels):
+        return tuple(labels.get(name, "") for name in self.labels)
+
+    def dump(self):
+        """Copy of the values, as (label values, value) pairs"""
+        with self.lock:
+            return [[list(key), value] for key, value in self.values.items()]
+
+    def merge(self, merged, key, value, pid):
+        """Adds the value of a worker to the ones merged so far"""
+        merged[key] = merged.get(key, 0) + value
+
+    def merged_labels(self):
+        return self.labels
+
+    def header(self):
+        return [
+            f"# HELP {self.name} {self.help_text}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+
+    def render(self, values=None, labels=None):
+        """Lines of the values, the metric's own unless given"""
+        if values is None:
+            with self.lock:
+                values = dict(self.values)
+        labels = labels or self.labels
+        lines = self.header()
+        for key, value in sorted(values.items()):
+            lines.append(
+                f"{self.name}{format_labels(labels, key)} "
+                f"{format_value(value)}"
+            )
+        return lines
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+    def merge(self, merged, key, value, pid):
+        """Gauges of the workers do not add up, each keeps its own"""
+        merged[key + (pid,)] = value
+
+    def merged_labels(self):
+        return self.labels + ("pid",)
+
+
+class Histogram(Metric):
+    """Values are [count of each bucket, sum, count]"""
+
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(buckets) + (float("inf"),)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is None:
+                entry = self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for position, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][position] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    def dump(self):
+        with self.lock:
+            return [
+                [list(key), [list(counts), total, count]]
+                for key, (counts, total, count) in self.values.items()
+            ]
+
+    def merge(self, merged, key, value, pid):
+        counts, total, count = value
+        entry = merged.setdefault(key, [[0] * len(self.buckets), 0.0, 0])
+        entry[0] = [a + b for a, b in zip(entry[0], counts)]
+        entry[1] += total
+        entry[2] += count
+
+    def render(self, values=None, labels=None):
+        if values is None:
+            with self.lock:
+                values = {
+                    key: (list(counts), total, count)
+                    for key, (counts, total, count) in self.values.items()
+                }
+        labels = labels or self.labels
+        lines = self.header()
+        for key, (counts, total, count) in sorted(values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                bucket_labels = format_labels(
+                    labels, key, [("le", format_value(bound))]
+                )
+                lines.append(
+                    f"{self.name}_bucket{bucket_labels} {cumulative}"
+                )
+            key_labels = format_labels(labels, key)
+            lines.append(f"{self.name}_sum{key_labels} {total!r}")
+            lines.append(f"{self.name}_count{key_labels} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def write(self, path, content=None):
+        """Renders to path, atomically so a scrape never reads half a file"""
+        temporary = f"{path}.{os.getpid()}.tmp"
+        with open(temporary, "w") as f:
+            f.write(self.render() if content is None else content)
+        os.replace(temporary, path)
+
+    def dump(self):
+        return {metric.name: metric.dump() for metric in self.metrics}
+
+    def write_worker(self, directory):
+        """Saves the values of this process in directory, named by pid"""
+        os.makedirs(directory, exist_ok=True)
+        self.write(
+            os.path.join(directory, f"{os.getpid()}.json"),
+            json.dumps(self.dump()),
+        )
+
+    def render_workers(self, directory):
+        """
+        Text format of the values of all the workers saved in directory,
+        the current ones of this process in place of its file.
+        """
+        own = str(os.getpid())
+        workers = {own: self.dump()}
+        for path in sorted(glob.glob(os.path.join(directory, "*.json"))):
+            pid = os.path.basename(path)[: -len(".json")]
+            if pid == own:
+                continue
+            try:
+                with open(path) as f:
+                    workers[pid] = json.load(f)
+            except (OSError, ValueError):
+                continue
+
+        merged = {metric.name: {} for metric in self.metrics}
+        for pid, worker in sorted(workers.items()):
+            for metric in self.metrics:
+                for key, value in worker.get(metric.name, []):
+                    metric.merge(merged[metric.name], tuple(key), value, pid)
+
+        lines = []
+        for metric in self.metrics:
+            lines.extend(
+                metric.render(merged[metric.name], metric.merged_labels())
+            )
+        return "\n".join(lines) + "\n"
+
+    def clear(self):
+        for metric in self.metrics:
+            metric.values = {}
+            metric.lock = threading.Lock()
+
+
+REGISTRY = Registry()
+# A forked worker counts from zero, what its master counted before the fork
+# is not the worker's to report
+os.register_at_fork(after_in_child=REGISTRY.clear)
+# Pid of the process whose values are being saved, a forked worker starts
+# a saver of its own
+saving_pid = None
+
+
+def save_worker():
+    try:
+        REGISTRY.write_worker(METRICS_DIR)
+    except OSError as e:
+        print("FAILED", "metrics", e)
+
+
+def save_periodically():
+    while True:
+        time.sleep(METRICS_WRITE_INTERVAL)
+        save_worker()
+
+
+def start_saving():
+    """
+    Saves the values of this worker in METRICS_DIR every
+    METRICS_WRITE_INTERVAL, and on exit, off the requests.
+    """
+    global saving_pid
+    if METRICS_DIR is None or saving_pid == os.getpid():
+        return
+    if saving_pid is None:
+        atexit.register(save_worker)
+    saving_pid = os.getpid()
+    threading.Thread(target=save_periodically, daemon=True).start()
+
+
+def render():
+    """Text format of this process, or of all the workers in METRICS_DIR"""
+    if METRICS_DIR is None:
+        return REGISTRY.render()
+    return REGISTRY.render_workers(METRICS_DIR)
+
+
+# Api
+REQUEST_DURATION = REGISTRY.add(
+    Histogram(
+        "weatheh_http_request_duration_seconds",
+        "Time spent answering requests.",
+        ["route", "method"],
+    )
+)
+REQUESTS = REGISTRY.add(
+    Counter(
+        "weatheh_http_requests_total",
+        "Requests answered.",
+        ["route", "method", "status"],
+    )
+)
+
+# Mongo, in both processes
+MONGO_DURATION = REGISTRY.add(
+    Histogram(
+        "weatheh_mongo_command_duration_seconds",
+        "Time mongo took to answer commands.",
+        ["command", "collection"],
+    )
+)
+MONGO_FAILURES = REGISTRY.add(
+    Counter(
+        "weatheh_mongo_command_failures_total",
+        "Mongo commands that failed.",
+        ["command", "collection"],
+    )
+)
+
+# Populate
+FETCH_DURATION = REGISTRY.add(
+    Histogram(
+        "weatheh_populate_fetch_duration_seconds",
+        "Time taken by each citypage request to dd.weather.gc.ca.",
+        ["status"],
+    )
+)
+PARSE_DURATION = REGISTRY.add(
+    Histogram(
+        "weatheh_populate_parse_duration_seconds",
+        "Time taken to parse each citypage document.",
+    )
+)
+WRITE_DURATION = REGISTRY.add(
+    Histogram(
+        "weatheh_populate_write_duration_seconds",
+        "Time taken by each batch of forecast writes.",
+    )
+)
+CYCLE_DURATION = REGISTRY.add(
+    Histogram(
+        "weatheh_populate_cycle_duration_seconds",
+        "Time taken by each forecast refresh cycle.",
+    )
+)
+FETCH_FAILURES = REGISTRY.add(
+    Counter(
+        "weatheh_populate_fetch_failures_total",
+        "Citypage documents that could not be fetched or parsed.",
+        ["province"],
+    )
+)
+SKIPPED_WRITES = REGISTRY.add(
+    Counter(
+        "weatheh_populate_skipped_writes_total",
+        "Forecasts fetched and parsed the same as the saved ones.",
+    )
+)
+LISTING_FAILURES = REGISTRY.add(
+    Counter(
+        "weatheh_populate_listing_failures_total",
+        "Province listings that could not be fetched.",
+        ["province"],
+    )
+)
+LAST_CYCLE = REGISTRY.add(
+    Gauge(
+        "weatheh_populate_last_cycle_timestamp_seconds",
+        "When the last forecast refresh cycle ended.",
+    )
+)
+FORECAST_AGE = REGISTRY.add(
+    Gauge(
+        "weatheh_populate_forecast_age_seconds",
+        "Time since the freshest and the stalest forecasts were saved.",
+        ["forecast"],
+    )
+)
+SCHEDULER_BACKLOG = REGISTRY.add(
+    Gauge(
+        "weatheh_populate_scheduler_overdue_cities",
+        "Cities due for a refresh the request budget could not afford yet.",
+    )
+)
+SCHEDULER_BUDGET = REGISTRY.add(
+    Gauge(
+        "weatheh_populate_scheduler_budget_requests",
+        "Requests to dd.weather.gc.ca the scheduler can make right now.",
+    )
+)
+
+
+def route_name(resource):
+    return type(resource).__name__ if resource is not None else "none"
+
+
+class MetricsMiddleware:
+    """Latency and status of every request, by resource"""
+
+    def process_request(self, req, resp):
+        start_saving()
+        req.context.metrics_start = time.perf_counter()
+
+    def process_response(self, req, resp, resource, req_succeeded):
+        start = getattr(req.context, "metrics_start", None)
+        if start is None:
+            return
+        route = route_name(resource)
+        REQUEST_DURATION.observe(
+            time.perf_counter() - start, route=route, method=req.method
+        )
+        REQUESTS.inc(
+            route=route,
+            method=req.method,
+            status=str(resp.status).split(" ")[0],
+        )
+
+
+class AsyncMetricsMiddleware(MetricsMiddleware):
+    """MetricsMiddleware of the ASGI app"""
+
+    async def process_request(self, req, resp):
+        super().process_request(req, resp)
+
+    async def process_response(self, req, resp, resource, req_succeeded):
+        super().process_response(req, resp, resource, req_succeeded)
+
+
+class MongoCommandListener(monitoring.CommandListener):
+    """Duration of every mongo command, by command and collection"""
+
+    def __init__(self):
+        # (command, collection) of the commands awaiting a reply
+        self.commands = {}
+
+    def key(self, event):
+        return event.connection_id, event.request_id
+
+    def started(self, event):
+        collection = event.command.get(event.command_name)
+        self.commands[self.key(event)] = (
+            event.command_name,
+            collection if isinstance(collection, str) else "",
+        )
+
+    def pop_command(self, event):
+        return self.commands.pop(self.key(event), (event.command_name, ""))
+
+    def succeeded(self, event):
+        command, collection = self.pop_command(event)
+        MONGO_DURATION.observe(
+            event.duration_micros / 1e6,
+            command=command,
+            collection=collection,
+        )
+
+    def failed(self, event):
+        command, collection = self.pop_command(event)
+        MONGO_DURATION.observe(
+            event.duration_micros / 1e6,
+            command=command,
+            collection=collection,
+        )
+        MONGO_FAILURES.inc(command=command, collection=collection)
+
+
+# noinspection PyMethodMayBeStatic
+class Metrics:
+    def on_get(self, req, resp):
+        resp.content_type = CONTENT_TYPE
+        resp.data = render().encode()
+
+
+# noinspection PyMethodMayBeStatic
+class AsyncMetrics:
+    async def on_get(self, req, resp):
+        resp.content_type = CONTENT_TYPE
+        resp.data = render().encode()
@@ -1,15 +1,23 @@
+import argparse
 import csv
 import datetime
+import email.utils
 import os
+import re
 import shutil
+import tempfile
 import time
 import sys
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
 
 import lxml.etree as etree
+import numpy
 import pymongo
+from pymongo import UpdateOne
 
-from weatheh import app, utils
+from weatheh import db, metrics, utils
+from weatheh.scheduler import RefreshScheduler
 from bson import ObjectId
 
 
@@ -21,15 +29,91 @@ SITE_LIST_FR_URL = (
 )
 
 
+# Canadian Geographical Names, downloaded by add_more_cities(download=True)
+CGN_CSV = "temp/cgn_canada_csv_eng.csv"
+# Concise codes of the places added as cities
+CGN_CODES = {
+    "IR",
+    "UNP",
+    "MTN",
+    "MUN1",
+    "GEOG",
+    "VILG",
+    "CITY",
+    "TOWN",
+    "MUN2",
+}
+CGN_EXCLUDED_TERMS = {
+    "Post Office",
+    "Former Post Office",
+    "Abandoned Locality",
+    "Railway Junction",
+    "Police Village",
+    "Military Post Office",
+    "Railway Yard",
+    "Former Railway Point",
+    "Judicial District",
+    "Landing",
+    "Railway Point",
+    "Railway Stop",
+}
+CGN_PROVINCES = {
+    "Alberta": "AB",
+    "Northwest Territories": "NT",
+    "British Columbia": "BC",
+    "Ontario": "ON",
+    "Prince Edward Island": "PE",
+    "Newfoundland and Labrador": "NL",
+    "Manitoba": "MB",
+    "Nova Scotia": "NS",
+    "Nunavut": "NU",
+    "Quebec": "QC",
+    "Saskatchewan": "SK",
+    "New Brunswick": "NB",
+    "Yukon": "YT",
+}
+# Places measured at once against the stations or cities of a province
+NEAREST_CHUNK = 4096
+
 GEONAMES_CANADA_DUMP = "http://download.geonames.org/export/dump/CA.zip"
 GEONAMES_JSON = "geonames.json"
 STATIONS_JSON = "stations.json"
 CITIES_JSON = "cities.json"
 ICONS_URL = "https://weather.gc.ca/weathericons/"
 ICONS_DESCRIPTIONS = (
-    "http://dd.weather.gc.ca/citypage_weather/docs/"
+    utils.BASE_HOST_DD_WEATHER + "/citypage_weather/docs/"
     "current_conditions_icon_code_descriptions_e.csv"
 )
+SWOB_STATION_LIST_URL = (
+    utils.BASE_HOST_DD_WEATHER + "/observations/doc/swob-xml_station_list.csv"
+)
+
+FULL_REFRESH_INTERVAL = 5 * 60
+LISTING_REFRESH_INTERVAL = 60
+SCHEDULED_REFRESH_INTERVAL = 5
+
+# Cities saved at once while building the database
+BUILD_BATCH = 200
+
+# Read by the node exporter textfile collector, kept out of the checkout
+METRICS_FILE = os.environ.get(
+    "WEATHEH_METRICS_FILE",
+    os.path.join(tempfile.gettempdir(), "weatheh", "populate.prom"),
+)
+
+# A row of the apache index of a province, ie:
+# <a href="s0000001_e.xml">s0000001_e.xml</a>   2019-01-10 14:05  8.1K
+LISTING_ROW_RE = re.compile(
+    r'href="(?P<code>s\d{7})_(?P<language>[ef])\.xml".*?'
+    r"(?P<modified>\d{2,4}-\w{2,3}-\d{2,4} \d{2}:\d{2}(?::\d{2})?)"
+)
+
+# Listing times, in utc, of apache's current and older directory indexes
+LISTING_TIME_FORMATS = ("%Y-%m-%d %H:%M", "%d-%b-%Y %H:%M")
+
+# Modification time of every citypage file as last seen in the listings,
+# keyed by (code, language)
+LISTING_MODIFIED = {}
 
 PROVINCES = {
     "AB": {"en": "Alberta", "fr": "Alberta"},
@@ -63,39 +147,27 @@ def clean_location(latitude, longitude):
 def get_raw_station_list():
     """
     Has many of the stations used by environment Canada with more precise
-    lat long. This populates a temp collection.
+    lat long, keyed by station code.
     https://open.canada.ca/data/en/dataset/9764d6c6-3044-450c-ac5a-383cedbfef17
     """
-    url = "http://dd.weather.gc.ca/observations/doc/swob-xml_station_list.csv"
-    r = app.session.get(url)
-    # stations = r.text.splitlines()[1:]
-    stations_list = []
+    r = db.session.get(SWOB_STATION_LIST_URL)
+    stations = {}
 
     for row in csv.reader(r.text.splitlines()[1:]):
         try:
-            stations_list.append(
-                {
-                    "stationCode": row[0].lower(),
-                    "loc": [float(row[5]), float(row[6])],
-                }
-            )
+            station = {
+                "stationCode": row[0].lower(),
+                "loc": [float(row[5]), float(row[6])],
+            }
         except ValueError:
-            pass
-    _stations = app.db["_stations"]
-
-    _stations.create_index([("loc", pymongo.GEO2D)])
-    app.stations_coll.create_index([("loc", pymongo.GEO2D)])
-    _stations.insert_many(stations_list)
-
-
-def populate_stations_and_cities():
-    """Grabs and saves the list of cities and finds weather stations as json"""
-    en = app.session.get(SITE_LIST_EN_URL).content.decode()
-    fr = app.session.get(SITE_LIST_FR_URL).content.decode()
+            continue
+        stations.setdefault(station["stationCode"], station)
+    return stations
 
-    cities_list = []
-    _stations = app.db["_stations"]
 
+def read_site_list(en, fr):
+    """Cities of the english and french site lists, less their station"""
+    cities = []
     for en_list, fr_list in zip(en.splitlines()[2:], fr.splitlines()[2:]):
         code, name_en, province, lat, lon = en_list.split(",")
         name_fr = fr_list.split(",")[1]
@@ -117,85 +189,202 @@ def populate_stations_and_cities():
 
         city["searchIndexEn"] = utils.normalize_string(city["nameEn"])
         city["searchIndexFr"] = utils.normalize_string(city["nameFr"])
+        cities.append(city)
+    return cities
 
-        url = utils.WEATHER_URL.format(city["province"], city["code"], "e")
-        r = app.session.get(url)
-        root_en = etree.fromstring(r.content)
 
-        url = utils.WEATHER_URL.format(city["province"], city["code"], "f")
-        r = app.session.get(url)
-        root_fr = etree.fromstring(r.content)
+def fetch_site_pages(city):
+    """
+    Parsed english and french citypages of a site, run in a worker thread.
+    Returns the error instead when either could not be fetched or parsed.
+    """
+    roots = {}
+    for language in ["en", "fr"]:
+        url = utils.WEATHER_URL.format(
+            city["province"], city["code"], language[0]
+        )
+        try:
+            r = db.session.get(url, timeout=utils.FETCH_TIMEOUT)
+            r.raise_for_status()
+            roots[language] = etree.fromstring(r.content)
+        except Exception as e:
+            print("FAILED", url, e)
+            return e
+    return roots
 
-        if root_en.find("currentConditions/station") is None:
-            continue
 
-        station_code = root_en.find("currentConditions/station").get("code")
-        station_doc = app.stations_coll.find_one(
-            {"stationCode": station_code.lower()}
-        )
-        if station_doc:
-            station_id = station_doc["_id"]
+def join_station(city, roots, stations, swob_stations):
+    """
+    Sets the weather station of a city from its citypage. stations holds
+    the known stations by lowercase code, a station seen for the first time
+    is added to it and returned, with the more precise location of the SWOB
+    station list when it has one.
+    """
+    station_en = roots["en"].find("currentConditions/station")
+    station_fr = roots["fr"].find("currentConditions/station")
+    station_code = station_en.get("code")
+
+    new_station = None
+    station = stations.get(station_code.lower())
+    if station is None:
+        swob_station = swob_stations.get(station_code.lower())
+        if swob_station:
+            station = dict(swob_station)
         else:
-            station_id = ObjectId()
-            _station_doc = _stations.find_one(
-                {"stationCode": station_code.lower()}
-            )
+            station = {
+                "stationCode": station_code,
+                "loc": clean_location(
+                    latitude=station_en.get("lat"),
+                    longitude=station_en.get("lon"),
+                ),
+            }
+        station["_id"] = ObjectId()
+        station["province"] = city["province"]
+        station["nameEn"] = station_en.text
+        station["nameFr"] = station_fr.text
+        stations[station_code.lower()] = new_station = station
+
+    city["stationCode"] = station_code
+    city["stationId"] = station["_id"]
+    city["stationEn"] = station_en.text
+    city["stationFr"] = station_fr.text
+    return new_station
+
+
+def save_build_batch(stations, cities):
+    """Stations first, so that saved cities never point to a missing one"""
+    if stations:
+        db.stations_coll.insert_many(stations, ordered=False)
+    if cities:
+        db.cities_coll.insert_many(cities, ordered=False)
+    stations.clear()
+    cities.clear()
+
+
+def create_build_indexes():
+    db.stations_coll.create_index([("loc", pymongo.GEO2D)])
+    db.cities_coll.create_index(
+        [
+            ("searchIndexEn", pymongo.TEXT),
+            ("searchIndexFr", pymongo.TEXT),
+            ("code", pymongo.TEXT),
+        ]
+    )
+    db.cities_coll.create_index([("loc", pymongo.GEO2D)])
+
 
-            if _station_doc:
-                _station_doc.pop("_id")
-                _station_doc["nameEn"] = root_en.find(
-                    "currentConditions/station"
-                ).text
-                _station_doc["nameFr"] = root_fr.find(
-                    "currentConditions/station"
-                ).text
-                _station_doc["province"] = city["province"]
-                app.stations_coll.insert_one(_station_doc)
+def populate_stations_and_cities(
+    swob_stations=None, workers=utils.FORECAST_WORKERS
+):
+    """
+    Grabs and saves the list of cities and finds their weather stations.
+    Citypages are fetched concurrently and joined in memory with the SWOB
+    station list, stations and cities are saved with batched inserts. Sites
+    saved by a previous run are skipped, a failed build is resumed by
+    running it again.
+    """
+    if swob_stations is None:
+        swob_stations = get_raw_station_list()
+    en = db.session.get(SITE_LIST_EN_URL).content.decode()
+    fr = db.session.get(SITE_LIST_FR_URL).content.decode()
+    create_build_indexes()
+
+    saved = {
+        c["code"]
+        for c in db.cities_coll.find({"authoritative": True}, {"code": 1})
+    }
+    stations = {
+        s["stationCode"].lower(): s for s in db.stations_coll.find()
+    }
+    sites = [c for c in read_site_list(en, fr) if c["code"] not in saved]
+    print("BUILD", f"sites={len(sites)}", f"resumed={len(saved)}")
+
+    utils.configure_session(workers)
+    start = time.time()
+    new_stations, cities = [], []
+    done, skipped, failed = 0, 0, []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for city, roots in zip(sites, executor.map(fetch_site_pages, sites)):
+            done += 1
+            if isinstance(roots, Exception):
+                failed.append(city["code"])
+            elif roots["en"].find("currentConditions/station") is None:
+                skipped += 1
             else:
-                app.stations_coll.insert_one(
-                    {
-                        "stationCode": station_code,
-                        "province": city["province"],
-                        "loc": clean_location(
-                            latitude=root_en.find(
-                                "currentConditions/station"
-                            ).get("lat"),
-                            longitude=root_en.find(
-                                "currentConditions/station"
-                            ).get("lon"),
-                        ),
-                        "nameEn": root_en.find(
-                            "currentConditions/station"
-                        ).text,
-                        "nameFr": root_fr.find(
-                            "currentConditions/station"
-                        ).text,
-                    }
+                new_station = join_station(
+                    city, roots, stations, swob_stations
+                )
+                if new_station:
+                    new_stations.append(new_station)
+                cities.append(city)
+
+            if len(cities) >= BUILD_BATCH or done == len(sites):
+                save_build_batch(new_stations, cities)
+                print(
+                    "BUILD",
+                    f"{done}/{len(sites)}",
+                    f"skipped={skipped}",
+                    f"failed={len(failed)}",
+                    f"stations={len(stations)}",
+                    f"rate={done / (time.time() - start):.1f}/s",
                 )
 
-        city["stationCode"] = station_code
-        city["stationId"] = station_id
+    # The cities saved so far are served even if the build is resumed
+    utils.bump_generation("catalog")
+    if failed:
+        raise Exception(
+            f"{len(failed)} sites failed: {failed}, run again to resume"
+        )
 
-        city["stationEn"] = root_en.find("currentConditions/station").text
-        city["stationFr"] = root_fr.find("currentConditions/station").text
 
-        print(city)
-        cities_list.append(city)
+def split_forecasts():
+    """
+    Moves forecasts out of the cities into their own collection, to be run
+    once on a database built before the forecasts collection existed:
+    python -c  "from weatheh import populate; populate.split_forecasts()"
+    """
+    db.cities_coll.update_many({}, {"$unset": {"weather": ""}})
+    utils.bump_generation("catalog")
+    utils.populate_forecast()
 
-    if not all([c.get("stationCode") for c in cities_list]):
-        print("Missing stationCode")
-        raise Exception()
 
-    app.cities_coll.create_index(
-        [
-            ("searchIndexEn", pymongo.TEXT),
-            ("searchIndexFr", pymongo.TEXT),
-            ("code", pymongo.TEXT),
-        ]
-    )
-    app.cities_coll.create_index([("loc", pymongo.GEO2D)])
-    app.cities_coll.insert_many(cities_list)
-    app.db.drop_collection("_stations")
+def materialize_city_payloads():
+    """
+    Saves the json each city is served with, less its weather, and its gzip
+    fragment. To be run again whenever cities are added or changed:
+    python -c  "import weatheh.populate as p; p.materialize_city_payloads()"
+    """
+    writes = []
+    for city in db.cities_coll.find(
+        {}, {"payload": 0, "gzip": 0, "weather": 0}
+    ):
+        writes.append(
+            UpdateOne(
+                {"_id": city["_id"]},
+                {
+                    "$set": {
+                        **{
+                            f"payload.{language}": utils.city_payload(
+                                city, language
+                            )
+                            for language in ["en", "fr"]
+                        },
+                        **{
+                            f"gzip.{language}": utils.city_gzip(
+                                city, language
+                            )
+                            for language in ["en", "fr"]
+                        },
+                    }
+                },
+            )
+        )
+        if len(writes) >= 1000:
+            db.cities_coll.bulk_write(writes, ordered=False)
+            writes = []
+    if writes:
+        db.cities_coll.bulk_write(writes, ordered=False)
+    utils.bump_generation("catalog")
 
 
 def init_mongodb():
@@ -203,18 +392,17 @@ def init_mongodb():
     In a path when weatheh is:
     python -c  "from weatheh import populate; populate.init_mongodb()"
     """
-    app.client.drop_database(app.MONGO_DB_NAME)
-    app.client.fsync()
+    db.client.drop_database(db.MONGO_DB_NAME)
+    utils.create_updates_collection()
+    db.client.fsync()
 
-    get_raw_station_list()
-    app.client.fsync()
-
-    populate_stations_and_cities()
-    app.client.fsync()
+    populate_stations_and_cities(get_raw_station_list())
+    db.client.fsync()
 
     add_more_cities()
-    app.client.fsync()
+    db.client.fsync()
 
+    materialize_city_payloads()
     utils.populate_forecast()
 
 
@@ -225,7 +413,7 @@ def download_file(folder_name, url, unzip=True, clean_target=True):
         os.mkdir(folder_name)
 
     file_name = url.split("/")[-1]
-    r = app.session.get(url, stream=True)
+    r = db.session.get(url, stream=True)
     if not r.ok:
         raise Exception(r.status_code)
 
@@ -239,188 +427,170 @@ def download_file(folder_name, url, unzip=True, clean_target=True):
             z.extractall(folder_name)
 
 
-def add_more_cities(download=False):
-    # https://open.canada.ca/data/en/dataset/e27c6eba-3c5d-4051-9db2-082dc6411c2c
-    codes = ["IR", "UNP", "MTN", "MUN1", "GEOG", "VILG", "CITY", "TOWN", "MUN2"]
-
-    generic_terms = [
-        "Post Office",
-        "Former Post Office",
-        "Abandoned Locality",
-        "Railway Junction",
-        "Police Village",
-        "Military Post Office",
-        "Railway Yard",
-        "Former Railway Point",
-        "Judicial District",
-        "Landing",
-        "Railway Point",
-        "Railway Stop",
-    ]
-
-    if download:
-        en_url = (
-            "http://ftp.geogratis.gc.ca/pub/nrcan_rncan/vector/"
-            "geobase_cgn_toponyme/prov_csv_eng/cgn_canada_csv_eng.zip"
-        )
-        download_file(
-            folder_name="temp", url=en_url, unzip=True, clean_target=False
-        )
-
-    with open("temp/cgn_canada_csv_eng.csv", newline="") as f:
-        geo = list(csv.reader(f))
-
-    provinces = {
-        "Alberta": "AB",
-        "Northwest Territories": "NT",
-        "British Columbia": "BC",
-        "Ontario": "ON",
-        "Prince Edward Island": "PE",
-        "Newfoundland and Labrador": "NL",
-        "Manitoba": "MB",
-        "Nova Scotia": "NS",
-        "Nunavut": "NU",
-        "Quebec": "QC",
-        "Saskatchewan": "SK",
-        "New Brunswick": "NB",
-        "Yukon": "YT",
-    }
-
-    client = pymongo.MongoClient()
-    db = client.weatheh
-    cities = db.cities
-    stations = db.stations
-
-    results_dict = {}
-    for row in geo[1:]:
-        (
-            cgndb_id,
-            name,
-            _,
-            _,
-            generic_term,
-            _,
-            code,
-            toponymic_id,
-            lat,
-            lon,
-            location,
-            province,
-            _,
-            _,
-            _,
-        ) = row
-
-        if generic_term in generic_terms:
-            continue
-
-        if not lat or not lon:
-            continue
-
-        name = name.strip()
-        cgndb_id = cgndb_id.strip()
-        code = code.strip()
-        toponymic_id = toponymic_id.strip()
-
-        if code not in codes:
-            continue
+def read_cgn_places(path, saved_names):
+    """
+    Streams the populated places of the CGN csv worth adding as cities.
+    saved_names holds the (nameEn, province) of the cities already saved,
+    which are left out. Names shared by places in different locations of a
+    province are ambiguous and left out too.
+    """
+    groups = {}
+    with open(path, newline="") as f:
+        rows = csv.reader(f)
+        next(rows, None)
+        for row in rows:
+            (
+                cgndb_id,
+                name,
+                _,
+                _,
+                generic_term,
+                _,
+                code,
+                toponymic_id,
+                lat,
+                lon,
+                location,
+                province,
+                _,
+                _,
+                _,
+            ) = row
+
+            if generic_term in CGN_EXCLUDED_TERMS:
+                continue
 
-        if ";" in location:
-            loc = location.split(";")
-            location = list(set([l.strip() for l in loc if l]))
-        else:
-            if not location:
+            if not lat or not lon:
                 continue
-            location = [location]
 
-        if cities.find_one({"nameEn": name, "province": provinces[province]}):
-            print("ALREADY SAVED:", name, province, location)
-            continue
+            code = code.strip()
+            if code not in CGN_CODES:
+                continue
 
-        print("ADDING SAVED:", name, province, location)
+            if ";" in location:
+                loc = location.split(";")
+                location = list(set([l.strip() for l in loc if l]))
+            else:
+                if not location:
+                    continue
+                location = [location]
 
-        if name in location:
-            # location = [name.strip()]
-            is_parent = True
-        else:
-            is_parent = False
+            name = name.strip()
+            province = CGN_PROVINCES.get(province)
+            if province is None or (name, province) in saved_names:
+                continue
 
-        place = {
-            "id": cgndb_id,
-            "name": name,
-            "code": code,
-            "toponymicId": toponymic_id,
-            "loc": [float(lat), float(lon)],
-            "locations": sorted(location),
-            "province": provinces[province],
-            "provinceEn": PROVINCES[provinces[province]]["en"],
-            "provinceFr": PROVINCES[provinces[province]]["fr"],
-            "isParent": is_parent,
-        }
+            place = {
+                "id": cgndb_id.strip(),
+                "name": name,
+                "code": code,
+                "toponymicId": toponymic_id.strip(),
+                "loc": [float(lat), float(lon)],
+                "locations": sorted(location),
+                "province": province,
+                "provinceEn": PROVINCES[province]["en"],
+                "provinceFr": PROVINCES[province]["fr"],
+                "isParent": name in location,
+            }
+            places = groups.setdefault((name, province), [])
+            if not any(p["locations"] == place["locations"] for p in places):
+                places.append(place)
 
-        key_name = f"{place['name']},{place['province']}"
-        if key_name not in results_dict:
-            results_dict[key_name] = [place]
-        else:
-            if not any(
-                [
-                    p["locations"] == place["locations"]
-                    for p in results_dict[key_name]
-                ]
-            ):
-                results_dict[key_name].append(place)
+    return [places[0] for places in groups.values() if len(places) == 1]
 
-    results = []
 
-    for name, places in results_dict.items():
-        if len(places) == 1:
-            results.append(places[0])
+def nearest_points(points, candidates):
+    """
+    Position of the nearest candidate of each point by planar distance on
+    [lat, lon], like $near on a 2d index, computed in chunks of points.
+    """
+    points = numpy.asarray(points, dtype=numpy.float64).reshape(-1, 2)
+    candidates = numpy.asarray(candidates, dtype=numpy.float64)
+    nearest = numpy.empty(len(points), dtype=numpy.int64)
+    for start in range(0, len(points), NEAREST_CHUNK):
+        chunk = points[start:start + NEAREST_CHUNK]
+        distances = (
+            (chunk[:, numpy.newaxis, :] - candidates[numpy.newaxis]) ** 2
+        ).sum(axis=2)
+        nearest[start:start + len(chunk)] = distances.argmin(axis=1)
+    return nearest
+
+
+def find_cgn_parents(places):
+    """
+    Authoritative city each place is attached to: the nearest one served by
+    the nearest station of the place's province. Places without one are
+    left out.
+    """
+    stations_by_province = {}
+    for station in db.stations_coll.find({}, {"province": 1, "loc": 1}):
+        stations_by_province.setdefault(station.get("province"), []).append(
+            station
+        )
+    parents_by_station = {}
+    for city in db.cities_coll.find(
+        {"authoritative": True}, {"payload": 0, "gzip": 0, "weather": 0}
+    ):
+        key = (city.get("stationId"), city["province"])
+        parents_by_station.setdefault(key, []).append(city)
+
+    places_by_province = {}
+    for place in places:
+        places_by_province.setdefault(place["province"], []).append(place)
+
+    places_by_parent_station = {}
+    for province, province_places in places_by_province.items():
+        stations = stations_by_province.get(province)
+        if not stations:
+            print("No station in province", province, len(province_places))
             continue
+        nearest = nearest_points(
+            [p["loc"] for p in province_places], [s["loc"] for s in stations]
+        )
+        for place, position in zip(province_places, nearest):
+            key = (stations[position]["_id"], province)
+            places_by_parent_station.setdefault(key, []).append(place)
+
+    parents = []
+    for key, station_places in places_by_parent_station.items():
+        cities = parents_by_station.get(key)
+        if not cities:
+            print("No near city with station", key, len(station_places))
+            continue
+        nearest = nearest_points(
+            [p["loc"] for p in station_places], [c["loc"] for c in cities]
+        )
+        for place, position in zip(station_places, nearest):
+            parents.append((place, cities[position]))
+    return parents
 
-        unique_location_tracker = []
-        unique_places = []
-
-        for place in places:
-            if any(
-                [l in unique_location_tracker for l in place["locations"]]
-            ) or any(
-                [l["toponymicId"] == place["toponymicId"] for l in places]
-            ):
-                continue
-
-            unique_location_tracker.extend(place["locations"])
-            unique_places.append(place)
-        to_add = []
-
-        for place in unique_places:
-            for p in unique_places:
-                if list(set(p["locations"]).intersection(place["locations"])):
-                    continue
-                to_add.append(place)
-        results.extend(to_add)
 
-    inserts = []
-    for city in results:
-        station = stations.find_one(
-            {"province": city["province"], "loc": {"$near": city["loc"]}}
+def add_more_cities(download=False, path=CGN_CSV):
+    """
+    Adds the populated places of the Canadian Geographical Names as cities
+    served by the forecast of their nearest authoritative city.
+    https://open.canada.ca/data/en/dataset/e27c6eba-3c5d-4051-9db2-082dc6411c2c
+    """
+    if download:
+        en_url = (
+            "http://ftp.geogratis.gc.ca/pub/nrcan_rncan/vector/"
+            "geobase_cgn_toponyme/prov_csv_eng/cgn_canada_csv_eng.zip"
         )
-
-        if not station:
-            print("No station in province", city)
-            continue
-        parent = cities.find_one(
-            {
-                "stationId": station["_id"],
-                "authoritative": True,
-                "province": city["province"],
-                "loc": {"$near": city["loc"]},
-            }
+        download_file(
+            folder_name="temp", url=en_url, unzip=True, clean_target=False
         )
 
-        if not parent:
-            print("No near city with station", city)
-            continue
+    start = time.time()
+    saved_names = {
+        (c["nameEn"], c["province"])
+        for c in db.cities_coll.find({}, {"nameEn": 1, "province": 1})
+    }
+    places = read_cgn_places(path, saved_names)
+    parents = find_cgn_parents(places)
 
+    inserts = []
+    for city, parent in parents:
+        parent = dict(parent)
         parent.pop("_id")
         parent["authoritative"] = False
         parent["parentNameEn"] = parent["nameEn"]
@@ -430,20 +600,154 @@ def add_more_cities(download=False):
         parent["searchIndexEn"] = utils.normalize_string(city["name"])
         parent["searchIndexFr"] = utils.normalize_string(city["name"])
         parent["loc"] = city["loc"]
-
         inserts.append(parent)
-        print("ADDING TO MONGODB", city)
 
-    cities.insert_many(inserts)
+    for batch_start in range(0, len(inserts), BUILD_BATCH):
+        db.cities_coll.insert_many(
+            inserts[batch_start:batch_start + BUILD_BATCH], ordered=False
+        )
+    utils.bump_generation("catalog")
+    print(
+        "CGN",
+        f"places={len(places)}",
+        f"added={len(inserts)}",
+        f"time={time.time() - start:.2f}s",
+    )
+
+
+def listing_minute(modified):
+    """Minute of a listing time as a naive utc datetime, None if unknown"""
+    if modified.count(":") == 2:
+        modified = modified.rsplit(":", 1)[0]
+    for time_format in LISTING_TIME_FORMATS:
+        try:
+            return datetime.datetime.strptime(modified, time_format)
+        except ValueError:
+            continue
+    return None
+
+
+def fetch_province_listing(province):
+    """
+    Modification times of a province's citypage files and the minute the
+    listing was served at, by the server's clock. None on failure.
+    """
+    url = utils.LISTING_URL.format(province)
+    try:
+        r = db.session.get(url, timeout=utils.FETCH_TIMEOUT)
+        r.raise_for_status()
+    except Exception as e:
+        print("FAILED", url, e)
+        metrics.LISTING_FAILURES.inc(province=province)
+        return None
+
+    try:
+        served = email.utils.parsedate_to_datetime(r.headers["Date"])
+        served = served.astimezone(datetime.timezone.utc).replace(
+            tzinfo=None
+        )
+    except (KeyError, TypeError, ValueError):
+        served = datetime.datetime.utcnow()
+    listing = {
+        (m.group("code"), m.group("language")): m.group("modified")
+        for m in LISTING_ROW_RE.finditer(r.text)
+    }
+    return listing, served.replace(second=0, microsecond=0)
+
+
+def find_changed_forecasts():
+    """
+    Compares the province listings with the ones seen on the last refresh.
+    Returns the codes that changed, the provinces whose listing could not be
+    read and the listing entries to remember once the refresh is saved.
+    Listing times only go down to the minute, a file listed in the minute
+    it was served at may be rewritten again within that minute. It is not
+    remembered, so it is checked again, with a conditional GET, next time.
+    """
+    changed = set()
+    failed = []
+    seen = {}
+    with ThreadPoolExecutor(max_workers=len(PROVINCES)) as executor:
+        listings = executor.map(fetch_province_listing, PROVINCES)
+        for province, result in zip(PROVINCES, listings):
+            if result is None:
+                failed.append(province)
+                continue
+            listing, served = result
+            for key, modified in listing.items():
+                if LISTING_MODIFIED.get(key) != modified:
+                    changed.add(key[0])
+                    minute = listing_minute(modified)
+                    if minute is None or minute < served:
+                        seen[key] = modified
+    return changed, failed, seen
+
+
+def populate_changed_forecast():
+    """Refreshes only the forecasts changed according to the listings"""
+    changed, failed, seen = find_changed_forecasts()
+    print("LISTING", f"changed={len(changed)}", f"failed={failed}")
+    if changed or failed:
+        stats = utils.populate_forecast(
+            query={
+                "$or": [
+                    {"code": {"$in": sorted(changed)}},
+                    {"province": {"$in": failed}},
+                ]
+            }
+        )
+        # Files that could not be fetched stay changed, they are retried on
+        # the next refresh
+        for code, language in stats["failed"]:
+            seen.pop((code, language[0]), None)
+    LISTING_MODIFIED.update(seen)
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--mode",
+        choices=["full", "listing", "scheduled"],
+        default="full",
+        help="listing only fetches the files changed in the province indexes,"
+        " scheduled fetches each site when its next observation is due",
+    )
+    parser.add_argument("--interval", type=int)
+    parser.add_argument(
+        "--budget",
+        type=float,
+        help="requests per minute to dd.weather.gc.ca in scheduled mode,"
+        " defaults to the volume of the full mode",
+    )
+    parser.add_argument(
+        "--metrics-file",
+        default=METRICS_FILE,
+        help="prometheus text file rewritten after every cycle",
+    )
+    args = parser.parse_args()
+
+    if args.mode == "listing":
+        refresh = populate_changed_forecast
+        interval = args.interval or LISTING_REFRESH_INTERVAL
+    elif args.mode == "scheduled":
+        refresh = RefreshScheduler(args.budget, FULL_REFRESH_INTERVAL).run_once
+        interval = args.interval or SCHEDULED_REFRESH_INTERVAL
+    else:
+        refresh = utils.populate_forecast
+        interval = args.interval or FULL_REFRESH_INTERVAL
+
     while True:
         start = time.time()
-        utils.populate_forecast()
+        refresh()
+        utils.record_forecast_ages()
+        metrics.LAST_CYCLE.set(time.time())
+        if args.metrics_file:
+            path = os.path.abspath(args.metrics_file)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            metrics.REGISTRY.write(path)
         print(
             datetime.datetime.utcnow(),
             datetime.timedelta(seconds=time.time() - start)
         )
         sys.stdout.flush()
-        time.sleep(5 * 60)
+        time.sleep(interval)
@@ -0,0 +1,208 @@
+"""
+Adaptive refresh of the forecasts, run by populate --mode scheduled.
+A site is due again when its next observation should be on
+dd.weather.gc.ca: an hour after its last one, plus the time its citypage
+took to follow an observation. Sites requested through the api are due
+sooner while they wait on it. Due sites are refreshed in order, within a
+budget of requests per minute that defaults to the volume of refreshing
+every site every FULL_REFRESH_INTERVAL.
+"""
+import datetime
+import email.utils
+import heapq
+import time
+
+from weatheh import db, metrics, utils
+
+# Citypages get a new observation every hour
+OBSERVATION_INTERVAL = 60 * 60
+# Time between an observation and its citypage until one was measured
+PUBLISH_DELAY = 10 * 60
+# Polling of a site whose next observation is late
+RETRY_INTERVAL = 5 * 60
+# Time between two refreshes of a site, the longest is for sites nobody
+# asks for, it also bounds how late forecasts issued between observations
+# are picked up. One request per minute halves it.
+MIN_REFRESH_INTERVAL = 60
+MAX_REFRESH_INTERVAL = 30 * 60
+# Requests to dd.weather.gc.ca refreshing a site, english and french
+REQUESTS_PER_SITE = 2
+# At most a minute of unused budget is spent in a burst
+BUDGET_BURST = 60
+
+POPULARITY_READ_INTERVAL = 60
+# Weight of the last read in the request rate of each site
+POPULARITY_SMOOTHING = 0.5
+CITIES_READ_INTERVAL = 60 * 60
+
+FORECAST_PROJECTION = {"weather.en.observationDatetimeUtc": 1, "updated": 1}
+
+
+def iso_timestamp(value):
+    try:
+        return datetime.datetime.fromisoformat(value).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+def http_timestamp(value):
+    try:
+        return email.utils.parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+class RefreshScheduler:
+    """
+    Priority queue of (due time, site code), each authoritative site is in
+    it once. budget is in requests per minute, None to match a refresh of
+    every site each refresh_interval seconds.
+    """
+
+    def __init__(self, budget=None, refresh_interval=5 * 60):
+        self.budget = budget
+        self.refresh_interval = refresh_interval
+        self.queue = []
+        self.scheduled = set()
+        self.tokens = 0.0
+        self.refilled = time.time()
+        self.cities_read = 0.0
+        # Seconds between the observation and the citypage of each site
+        self.delays = {}
+        # Requests counted by the api at the last read, and the smoothed
+        # requests per minute since, of each site
+        self.requests = {}
+        self.rates = {}
+        self.popularity_read = 0.0
+
+    def rate(self):
+        """Requests per second the budget allows"""
+        if self.budget is not None:
+            return self.budget / 60
+        return len(self.scheduled) * REQUESTS_PER_SITE / self.refresh_interval
+
+    def refill(self, now):
+        rate = self.rate()
+        self.tokens = min(
+            self.tokens + (now - self.refilled) * rate, rate * BUDGET_BURST
+        )
+        self.refilled = now
+
+    def read_cities(self, now):
+        """
+        Schedules the sites not scheduled yet from their saved forecast,
+        drops the ones gone.
+        """
+        codes = {
+            c["code"]
+            for c in db.cities_coll.find({"authoritative": True}, {"code": 1})
+        }
+        added = list(codes - self.scheduled)
+        forecasts = {
+            f["_id"]: f
+            for f in db.forecasts_coll.find(
+                {"_id": {"$in": added}}, FORECAST_PROJECTION
+            )
+        }
+        for code in added:
+            due = now
+            if code in forecasts:
+                due = self.next_due(code, forecasts[code], now)
+            heapq.heappush(self.queue, (due, code))
+        self.scheduled = codes
+        self.cities_read = now
+
+    def read_popularity(self, now):
+        """Requests per minute of each site, out of the api counts"""
+        totals = {
+            doc["_id"]: doc["requests"] for doc in db.popularity_coll.find()
+        }
+        if self.popularity_read:
+            minutes = (now - self.popularity_read) / 60
+            for code, total in totals.items():
+                recent = max(total - self.requests.get(code, 0), 0) / minutes
+                self.rates[code] = (
+                    POPULARITY_SMOOTHING * recent
+                    + (1 - POPULARITY_SMOOTHING) * self.rates.get(code, 0.0)
+                )
+        self.requests = totals
+        self.popularity_read = now
+
+    def next_due(self, code, forecast, now):
+        """When a site refreshed at now should be refreshed again"""
+        longest = max(
+            MAX_REFRESH_INTERVAL / (1 + self.rates.get(code, 0.0)),
+            MIN_REFRESH_INTERVAL,
+        )
+        weather = forecast.get("weather", {}).get("en", {})
+        observed = iso_timestamp(weather.get("observationDatetimeUtc"))
+        if observed is None:
+            return now + longest
+
+        validators = utils.FORECAST_VALIDATORS.get((code, "en"), {})
+        modified = http_timestamp(validators.get("lastModified"))
+        if modified is None and forecast.get("updated"):
+            modified = (
+                forecast["updated"]
+                .replace(tzinfo=datetime.timezone.utc)
+                .timestamp()
+            )
+        if (
+            modified is not None
+            and 0 <= modified - observed < OBSERVATION_INTERVAL
+        ):
+            # Citypages are also rewritten between observations, the
+            # shortest delay is the one of the observations
+            self.delays[code] = min(
+                self.delays.get(code, OBSERVATION_INTERVAL),
+                modified - observed,
+            )
+
+        expected = (
+            observed
+            + OBSERVATION_INTERVAL
+            + self.delays.get(code, PUBLISH_DELAY)
+        )
+        if expected <= now:
+            expected = now + RETRY_INTERVAL
+        return min(max(expected, now + MIN_REFRESH_INTERVAL), now + longest)
+
+    def reschedule(self, codes, now):
+        forecasts = {
+            f["_id"]: f
+            for f in db.forecasts_coll.find(
+                {"_id": {"$in": codes}}, FORECAST_PROJECTION
+            )
+        }
+        for code in codes:
+            due = self.next_due(code, forecasts.get(code, {}), now)
+            heapq.heappush(self.queue, (due, code))
+
+    def run_once(self):
+        """Refreshes the sites due the budget affords, returns their codes"""
+        now = time.time()
+        if now - self.cities_read > CITIES_READ_INTERVAL:
+            self.read_cities(now)
+        if now - self.popularity_read > POPULARITY_READ_INTERVAL:
+            self.read_popularity(now)
+        self.refill(now)
+
+        codes = []
+        while (
+            self.queue
+            and self.queue[0][0] <= now
+            and self.tokens >= REQUESTS_PER_SITE
+        ):
+            _, code = heapq.heappop(self.queue)
+            if code in self.scheduled:
+                codes.append(code)
+                self.tokens -= REQUESTS_PER_SITE
+        metrics.SCHEDULER_BACKLOG.set(
+            sum(1 for due, _ in self.queue if due <= now)
+        )
+        metrics.SCHEDULER_BUDGET.set(self.tokens)
+
+        if codes:
+            utils.populate_forecast(query={"code": {"$in": codes}})
+            self.reschedule(codes, time.time())
+        return codes
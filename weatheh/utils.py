@@ -1,318 +1,676 @@
 import datetime
-import json
+import hashlib
+import math
 import os
+import threading
+import time
 import unicodedata
-
-import lxml.etree as etree
-import pytz
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import falcon
+import ujson
+from bson import ObjectId
+from bson.errors import InvalidId
+from pymongo import UpdateOne
+from pymongo.errors import CollectionInvalid
+from requests.adapters import HTTPAdapter
 from requests.exceptions import RequestException
 from urllib3.exceptions import HTTPError
-from weatheh import app
+from weatheh import citypage, compression, db, history, metrics
 
-BASE_HOST_DD_WEATHER = "http://dd.weather.gc.ca"
+# Overridable to point populate at a local mirror of dd.weather.gc.ca
+BASE_HOST_DD_WEATHER = os.environ.get(
+    "WEATHEH_DD_WEATHER_HOST", "http://dd.weather.gc.ca"
+)
 WEATHER_URL = BASE_HOST_DD_WEATHER + "/citypage_weather/xml/{}/{}_{}.xml"
-
-icons_codes_path = os.path.join(os.path.dirname(__file__), "icons_codes.json")
-with open(icons_codes_path) as f:
-    WEATHER_ICONS = json.load(f)
-
-
-def populate_forecast():
-    """ Fetching all forecasts and updating"""
-    for city in app.cities_coll.find({"authoritative": True}):
-        city["weather"] = {}
-        for language in ["en", "fr"]:
-            url = WEATHER_URL.format(city["province"], city["code"], language[0])
-            try:
-                r = app.session.get(url)
-            except (RequestException, HTTPError) as e:
-                print("FAILED", url, e)
-                continue
-
-            try:
-                root = etree.fromstring(r.content)
-            except Exception:
-                print(r.content)
-                raise
-
-            timestamp_format = "%Y%m%d%H%M%S"
-            response = {
-                "warnings": [],
-                "current": {},
-                "longTerm": [],
-                "shortTerm": [],
-                "hourly": [],
+LISTING_URL = BASE_HOST_DD_WEATHER + "/citypage_weather/xml/{}/"
+
+# Concurrent requests made to dd.weather.gc.ca while refreshing forecasts
+FORECAST_WORKERS = int(os.environ.get("WEATHEH_FORECAST_WORKERS", 16))
+FETCH_TIMEOUT = 30
+FORECAST_WRITE_BATCH = 200
+
+# Forecasts are refreshed every minute by populate
+CACHE_MAX_AGE = 60
+
+# Parts of a forecast that can be asked for on their own
+WEATHER_SECTIONS = [
+    "warnings",
+    "current",
+    "observationDatetimeUtc",
+    "shortTerm",
+    "longTerm",
+    "hourly",
+]
+
+# Seconds the api trusts the last generations read from mongo
+GENERATION_CHECK_INTERVAL = 5
+_generations = {}
+
+# Forecasts served by this worker for each site code, added to the
+# popularity collection every POPULARITY_FLUSH_INTERVAL seconds where
+# populate reads them to schedule refreshes.
+POPULARITY_FLUSH_INTERVAL = 30
+_popularity = Counter()
+_popularity_lock = threading.Lock()
+_popularity_flushed = time.time()
+
+# Bytes of forecast_updates, the site codes of each forecast write tailed
+# by the api event streams
+UPDATES_COLLECTION_SIZE = 1024 * 1024
+_updates_created = False
+
+# HTTP validators (ETag, Last-Modified) of the last citypage saved for each
+# (code, language), kept for the life of the populate process.
+FORECAST_VALIDATORS = {}
+
+
+def populate_forecast(workers=FORECAST_WORKERS, query=None):
+    """
+    Fetching all forecasts and updating.
+    Fetching and parsing run concurrently in a bounded thread pool sharing
+    one pooled connection set to dd.weather.gc.ca, forecasts are saved once
+    per site code in the forecasts collection with batched bulk writes.
+    Documents that did not change since the last cycle are answered with a
+    304 and skipped, so are forecasts parsed the same as the saved ones,
+    compared by the hash of their json. Current conditions of the new ones
+    are added to the history of their station.
+    query optionally narrows down the authoritative cities refreshed.
+    Returns the stats of the cycle, failed being the (code, language) of
+    the documents that could not be fetched or parsed.
+    """
+    configure_session(workers)
+    stats = {
+        "fetch": 0.0,
+        "parse": 0.0,
+        "write": 0.0,
+        "hits": 0,
+        "misses": 0,
+        "bytesSaved": 0,
+        "skipped": 0,
+        "failed": [],
+    }
+    start = time.time()
+    count = 0
+
+    cities = list(
+        db.cities_coll.find(
+            {"authoritative": True, **(query or {})},
+            {"code": 1, "province": 1, "stationCode": 1},
+        )
+    )
+    hashes = {
+        f["_id"]: f.get("hash", {})
+        for f in db.forecasts_coll.find(
+            {"_id": {"$in": [c["code"] for c in cities]}}, {"hash": 1}
+        )
+    }
+
+    pending_validators = {}
+    writes = {}
+    observations = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(fetch_city_forecast, city) for city in cities
+        ]
+        for future in as_completed(futures):
+            city, weather, validators, city_stats = future.result()
+            for key, value in city_stats.items():
+                stats[key] += value
+            count += 1
+
+            code = city["code"]
+            changed = {
+                language: forecast
+                for language, forecast in weather.items()
+                if forecast_hash(to_json(forecast))
+                != hashes.get(code, {}).get(language)
             }
+            stats["skipped"] += len(weather) - len(changed)
+            if changed:
+                writes[code] = forecast_update(code, changed)
+                forecast = next(iter(changed.values()))
+                observations.append(
+                    (
+                        city.get("stationCode"),
+                        forecast["observationDatetimeUtc"],
+                        forecast["current"],
+                    )
+                )
+            pending_validators.update(validators)
+            if len(writes) >= FORECAST_WRITE_BATCH:
+                stats["write"] += save_forecasts(writes, pending_validators)
+
+    stats["write"] += save_forecasts(writes, pending_validators)
+    stats["write"] += history.record(observations)
+    metrics.CYCLE_DURATION.observe(time.time() - start)
+    metrics.SKIPPED_WRITES.inc(stats["skipped"])
+
+    print(
+        "CYCLE",
+        f"cities={count}",
+        f"workers={workers}",
+        f"wall={time.time() - start:.2f}s",
+        " ".join(format_stat(k, v) for k, v in stats.items()),
+    )
+    return stats
+
+
+def format_stat(name, value):
+    if isinstance(value, float):
+        return f"{name}={value:.2f}s"
+    if isinstance(value, list):
+        return f"{name}={len(value)}"
+    return f"{name}={value}"
+
+
+def configure_session(workers=FORECAST_WORKERS):
+    """
+    Keeps one connection per worker alive to dd.weather.gc.ca, the adapter
+    and its pool are only replaced when more workers need them.
+    """
+    session = db.session
+    mounted = session.adapters.get(BASE_HOST_DD_WEATHER)
+    if getattr(mounted, "workers", 0) >= workers:
+        return
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+    adapter.workers = workers
+    session.mount(BASE_HOST_DD_WEATHER, adapter)
+    if mounted is not None:
+        mounted.close()
+
+
+def fetch_city_forecast(city):
+    """
+    Fetches and parses both languages of a city, run in a worker thread.
+    Languages answered with a 304, or that could not be fetched or parsed,
+    are left out of the returned weather, the latter listed in failed.
+    """
+    stats = {
+        "fetch": 0.0,
+        "parse": 0.0,
+        "hits": 0,
+        "misses": 0,
+        "bytesSaved": 0,
+        "failed": [],
+    }
+    weather = {}
+    validators = {}
+    for language in ["en", "fr"]:
+        url = WEATHER_URL.format(city["province"], city["code"], language[0])
+        key = (city["code"], language)
+        cached = FORECAST_VALIDATORS.get(key, {})
+
+        headers = {}
+        if cached.get("etag"):
+            headers["If-None-Match"] = cached["etag"]
+        if cached.get("lastModified"):
+            headers["If-Modified-Since"] = cached["lastModified"]
+
+        fetch_start = time.time()
+        try:
+            r = db.session.get(url, headers=headers, timeout=FETCH_TIMEOUT)
+        except (RequestException, HTTPError) as e:
+            print("FAILED", url, e)
+            metrics.FETCH_FAILURES.inc(province=city["province"])
+            stats["failed"].append(key)
+            continue
+        finally:
+            stats["fetch"] += time.time() - fetch_start
+        metrics.FETCH_DURATION.observe(
+            time.time() - fetch_start, status=str(r.status_code)
+        )
 
-            # Warnings
-            for child in root.findall("warnings/event"):
-                if child.get("type", "").strip().lower() != "warning":
-                    continue
-                url = root.find("warnings").get("url")
-                warning = {
-                    "priority": child.get("priority", "").strip(),
-                    "description": child.get("description", "").strip(),
-                    "url": url
-                }
-                if warning["priority"] not in ["low", "high", "urgent"]:
-                    print(warning)
-                response["warnings"].append(warning)
-
-            # Current
-            observation_datetime_utc = None
-            for child in root.findall("currentConditions/dateTime"):
-                if child.get("zone") == "UTC":
-                    observation_datetime_utc = datetime.datetime.strptime(
-                        child.find("timeStamp").text, timestamp_format
-                    ).replace(tzinfo=pytz.UTC)
-
-            if observation_datetime_utc:
-                observation_datetime_utc = observation_datetime_utc.astimezone(
-                    pytz.UTC
-                ).isoformat()
-            response["observationDatetimeUtc"] = observation_datetime_utc
-
-            current_icon_code = getattr(
-                root.find("currentConditions/iconCode"), "text", None
-            )
-            if current_icon_code:
-                response["current"]["iconClass"] = WEATHER_ICONS.get(
-                    current_icon_code, {}
-                ).get("name", "we-na")
-            else:
-                response["current"]["iconClass"] = "we-na"
+        if r.status_code == 304:
+            stats["hits"] += 1
+            stats["bytesSaved"] += cached.get("size", 0)
+            continue
+        if r.status_code != 200:
+            print("FAILED", url, r.status_code)
+            metrics.FETCH_FAILURES.inc(province=city["province"])
+            stats["failed"].append(key)
+            continue
+        stats["misses"] += 1
+
+        parse_start = time.time()
+        try:
+            weather[language] = citypage.parse_citypage(r.content)
+        except Exception as e:
+            # Skipped like a failed fetch, the rest of the cycle is saved
+            print("FAILED", url, repr(e), r.content[:200])
+            metrics.FETCH_FAILURES.inc(province=city["province"])
+            stats["failed"].append(key)
+            continue
+        finally:
+            stats["parse"] += time.time() - parse_start
+        metrics.PARSE_DURATION.observe(time.time() - parse_start)
+
+        validators[key] = {
+            "etag": r.headers.get("ETag"),
+            "lastModified": r.headers.get("Last-Modified"),
+            "size": len(r.content),
+        }
+
+    return city, weather, validators, stats
+
+
+def forecast_hash(payload):
+    """Hash of a forecast's json, the same as long as the forecast is"""
+    return hashlib.sha1(payload).hexdigest()
+
+
+def forecast_update(code, weather):
+    """
+    Bulk operation saving the refreshed languages of a site's forecast,
+    along with the json the api serves for them, its gzip fragment and
+    hash.
+    """
+    update = {}
+    for language, forecast in weather.items():
+        payload = to_json(forecast)
+        update[f"weather.{language}"] = forecast
+        update[f"payload.{language}"] = payload
+        update[f"gzip.{language}"] = compression.deflate_fragment(payload)
+        update[f"hash.{language}"] = forecast_hash(payload)
+    return UpdateOne(
+        {"_id": code},
+        {
+            "$set": update,
+            "$inc": {"version": 1},
+            "$currentDate": {"updated": True},
+        },
+        upsert=True,
+    )
 
-            response["current"]["iconCode"] = to_int(current_icon_code)
 
-            current_temperature = getattr(
-                root.find("currentConditions/temperature"), "text", None
-            )
-            response["current"]["temperatureFloat"] = to_float(current_temperature)
-            response["current"]["temperature"] = to_float(
-                current_temperature, rounding=0
+def save_forecasts(writes, validators):
+    """
+    Flushes pending forecast writes, by site code, and publishes their codes.
+    Returns the time it took.
+    """
+    start = time.time()
+    if writes:
+        db.forecasts_coll.bulk_write(list(writes.values()), ordered=False)
+        bump_generation("forecasts")
+        publish_forecasts(list(writes))
+        metrics.WRITE_DURATION.observe(time.time() - start)
+    # Only trusting validators once their document is saved
+    FORECAST_VALIDATORS.update(validators)
+    writes.clear()
+    validators.clear()
+    return time.time() - start
+
+
+def create_updates_collection():
+    """
+    Capped so the api can tail it, the oldest updates make room for the
+    new ones.
+    """
+    try:
+        db.database.create_collection(
+            "forecast_updates", capped=True, size=UPDATES_COLLECTION_SIZE
+        )
+    except CollectionInvalid:
+        pass
+
+
+def publish_forecasts(codes):
+    """Tells the api event streams which site codes have a new forecast"""
+    global _updates_created
+    if not _updates_created:
+        create_updates_collection()
+        _updates_created = True
+    db.updates_coll.insert_one({"codes": codes})
+
+
+def record_forecast_ages():
+    """Age of the freshest and the stalest forecasts saved, in seconds"""
+    now = datetime.datetime.utcnow()
+    for forecast, direction in [("freshest", -1), ("stalest", 1)]:
+        for doc in (
+            db.forecasts_coll.find(
+                {"updated": {"$exists": True}}, {"updated": 1}
             )
+            .sort("updated", direction)
+            .limit(1)
+        ):
+            age = (now - doc["updated"]).total_seconds()
+            metrics.FORECAST_AGE.set(age, forecast=forecast)
 
-            current_description = getattr(
-                root.find("currentConditions/condition"), "text", None
-            )
-            response["current"]["description"] = current_description
-            response["current"]["forecastPeriod"] = response["current"][
-                "description"
-            ]
 
-            current_dew_point = getattr(
-                root.find("currentConditions/dewpoint"), "text", None
-            )
-            response["current"]["dewPoint"] = to_float(current_dew_point)
+def bump_generation(name):
+    """
+    Tells the api workers what they hold of name is stale, forecasts or
+    catalog.
+    """
+    db.meta_coll.update_one(
+        {"_id": name}, {"$inc": {"generation": 1}}, upsert=True
+    )
 
-            current_humidex = getattr(
-                root.find("currentConditions/humidex"), "text", None
-            )
-            response["current"]["humidex"] = to_int(current_humidex)
 
-            current_pressure_kpa = getattr(
-                root.find("currentConditions/pressure"), "text", None
+def current_generation(name):
+    """Current generation of name, read from mongo every few seconds"""
+    now = time.time()
+    value, checked = _generations.get(name, (None, 0.0))
+    if now - checked > GENERATION_CHECK_INTERVAL:
+        doc = db.meta_coll.find_one({"_id": name})
+        value = doc["generation"] if doc else 0
+        _generations[name] = (value, now)
+    return value
+
+
+def record_requests(codes):
+    """Counts a request for the forecast of each site code"""
+    with _popularity_lock:
+        _popularity.update(codes)
+
+
+def popularity_updates():
+    """
+    Bulk operations adding the requests counted since the last flush to the
+    popularity collection, none until POPULARITY_FLUSH_INTERVAL elapsed.
+    """
+    global _popularity_flushed
+    now = time.time()
+    with _popularity_lock:
+        if now - _popularity_flushed < POPULARITY_FLUSH_INTERVAL:
+            return []
+        counts = dict(_popularity)
+        _popularity.clear()
+        _popularity_flushed = now
+    return [
+        UpdateOne({"_id": code}, {"$inc": {"requests": n}}, upsert=True)
+        for code, n in counts.items()
+    ]
+
+
+def flush_popularity():
+    updates = popularity_updates()
+    if updates:
+        db.popularity_coll.bulk_write(updates, ordered=False)
+
+
+def find_forecasts(cities, language, sections=None):
+    """
+    Serialized forecast of each city's site code with its version and last
+    update, in one query. With sections, only those parts of the weather
+    are read from mongo and served.
+    """
+    query, projection = forecasts_query(cities, language, sections)
+    forecasts = {
+        f["_id"]: read_forecast(f, language, sections)
+        for f in db.forecasts_coll.find(query, projection)
+    }
+
+    stale = [code for code, f in forecasts.items() if f["payload"] is None]
+    if stale:
+        # Saved before payloads were materialized
+        for forecast in db.forecasts_coll.find(
+            {"_id": {"$in": stale}}, {f"weather.{language}": 1}
+        ):
+            forecasts[forecast["_id"]] = read_forecast(
+                forecast, language, WEATHER_SECTIONS
             )
-            response["current"]["pressureKpa"] = to_float(current_pressure_kpa)
-
-            current_visibility_km = getattr(
-                root.find("currentConditions/visibility"), "text", None
+    return forecasts
+
+
+def forecasts_query(cities, language, sections=None):
+    """Query and projection of the forecasts of the cities"""
+    codes = list({c["code"] for c in cities})
+    projection = {"version": 1, "updated": 1}
+    if sections:
+        for section in sections:
+            projection[f"weather.{language}.{section}"] = 1
+    else:
+        projection[f"payload.{language}"] = 1
+        projection[f"gzip.{language}"] = 1
+    return {"_id": {"$in": codes}}, projection
+
+
+def read_forecast(forecast, language, sections=None):
+    """
+    Serialized forecast, its gzip fragment, version and last update out of a
+    document projected by forecasts_query. The payload is None when it was
+    not materialized yet, the gzip fragment when it was not compressed or
+    only some sections are served.
+    """
+    gzip = None
+    if sections:
+        weather = forecast.get("weather", {}).get(language, {})
+        payload = to_json({s: weather[s] for s in sections if s in weather})
+    else:
+        payload = forecast.get("payload", {}).get(language)
+        gzip = forecast.get("gzip", {}).get(language)
+    return {
+        "payload": payload,
+        "gzip": gzip,
+        "version": forecast.get("version", 0),
+        "updated": forecast.get("updated"),
+    }
+
+
+def response_validators(
+    cities, forecasts, language, sections=None, catalog_generation=None
+):
+    """
+    Strong ETag and Last-Modified of the response of the cities, known
+    without serializing it. The ETag changes with the version of each
+    forecast, the sections served and the catalog generation the cities
+    come from.
+    """
+    if catalog_generation is None:
+        catalog_generation = current_generation("catalog")
+    versions = "|".join(
+        f"{c['_id']}:{forecasts.get(c['code'], {}).get('version', 0)}"
+        for c in cities
+    )
+    variant = ",".join(sections or [])
+    digest = hashlib.sha1(
+        f"{language}|{variant}|{catalog_generation}|{versions}"
+        .encode()
+    ).hexdigest()
+    updates = [
+        f["updated"] for f in forecasts.values() if f.get("updated")
+    ]
+    return f'"{digest}"', max(updates) if updates else None
+
+
+def send_cached(req, resp, etag, last_modified, build, build_gzip=None):
+    """
+    Sets the caching headers of a response, build() is only called for its
+    body when the client's copy is stale. build_gzip(), when given, builds
+    the gzip body sent to clients accepting it.
+    """
+    resp.vary = ["Accept-Encoding"]
+    gzip = build_gzip is not None and compression.accepts_gzip(req)
+    if gzip:
+        # Each encoding of a response is a representation of its own
+        etag = etag[:-1] + '-gzip"'
+        build = build_gzip
+    resp.etag = etag
+    if last_modified:
+        resp.last_modified = last_modified
+    resp.cache_control = [f"max-age={CACHE_MAX_AGE}"]
+
+    if_none_match = req.get_header("If-None-Match")
+    if if_none_match:
+        not_modified = etag_matches(if_none_match, etag)
+    else:
+        try:
+            since = req.get_header_as_datetime("If-Modified-Since")
+        except falcon.HTTPBadRequest:
+            since = None
+        if since and since.tzinfo:
+            # Falcon 4 parses it timezone aware, mongo dates are naive utc
+            since = since.astimezone(datetime.timezone.utc).replace(
+                tzinfo=None
             )
-            response["current"]["visibilityKm"] = to_float(current_visibility_km)
+        not_modified = bool(
+            since and last_modified and last_modified.replace(microsecond=0)
+            <= since
+        )
 
-            current_relative_humidity = getattr(
-                root.find("currentConditions/relativeHumidity"), "text", None
-            )
-            response["current"]["relativeHumidity"] = to_int(
-                current_relative_humidity
-            )
+    if not_modified:
+        resp.status = falcon.HTTP_304
+    else:
+        if gzip:
+            resp.set_header("Content-Encoding", "gzip")
+        resp.data = build()
+        resp.status = falcon.HTTP_200
+
+
+def etag_matches(if_none_match, etag):
+    """Weak comparison of an If-None-Match header against an ETag"""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    return any(
+        tag.strip().replace("W/", "", 1) == etag
+        for tag in if_none_match.split(",")
+    )
 
-            current_wind_speed = getattr(
-                root.find("currentConditions/wind/speed"), "text", None
-            )
-            response["current"]["windSpeed"] = to_int(current_wind_speed)
 
-            current_wind_gust = getattr(
-                root.find("currentConditions/wind/gust"), "text", None
-            )
-            response["current"]["windGust"] = current_wind_gust
+def city_payload(city, language):
+    """Serialized city, less its weather"""
+    doc = {
+        k: v
+        for k, v in city.items()
+        if k not in ["payload", "gzip", "weather"]
+    }
+    return to_json(normalize_city(doc, language))
 
-            current_wind_direction = getattr(
-                root.find("currentConditions/wind/direction"), "text", None
-            )
-            response["current"]["windDirection"] = current_wind_direction
 
-            current_wind_bearing_degree = getattr(
-                root.find("currentConditions/wind/bearing"), "text", None
-            )
-            response["current"]["windBearingDegree"] = to_float(
-                current_wind_bearing_degree
-            )
+def city_response(city, forecast_payload, language):
+    """Splices the materialized city and forecast json into one response"""
+    payload = city.get("payload", {}).get(language)
+    if payload is None:
+        payload = city_payload(city, language)
+    return b"".join(
+        [payload[:-1], b',"weather":', forecast_payload or b"{}", b"}"]
+    )
 
-            regional_normals_summary = getattr(
-                root.find("forecastGroup/regionalNormals/textSummary"), "text", None
-            )
-            response["current"]["regionalNormalsSummary"] = regional_normals_summary
-
-            regional_normal_low, regional_normal_high = None, None
-            for normal in root.findall(
-                "forecastGroup//regionalNormals/temperature"
-            ):
-                if normal.get("class") == "high":
-                    regional_normal_high = normal.text
-                if normal.get("class") == "low":
-                    regional_normal_low = normal.text
-            response["current"]["regionalNormalLow"] = to_int(regional_normal_low)
-            response["current"]["regionalNormalHigh"] = to_int(regional_normal_high)
-
-            # Short and long term
-            days = [
-                "monday",
-                "lundi",
-                "tuesday",
-                "mardi",
-                "wednesday",
-                "mercredi",
-                "thursday",
-                "jeudi",
-                "friday",
-                "vendredi",
-                "saturday",
-                "samedi",
-                "sunday",
-                "dimanche"
-            ]
-            for forecast in root.findall("forecastGroup/forecast"):
-                forecast_dict = {}
-
-                period_group = forecast.find("period")
-                period = period_group.get("textForecastName")
-                forecast_dict["forecastPeriod"] = period
-
-                description = getattr(period_group, "text", None)
-                forecast_dict["description"] = description
-
-                summary = getattr(forecast.find("textSummary"), "text", None)
-                forecast_dict["summary"] = summary
-
-                cloud_precipitation = getattr(
-                    forecast.find("cloudPrecip/textSummary"), "text", None
-                )
-                forecast_dict["cloudPrecipitation"] = cloud_precipitation
 
-                icon_code = getattr(
-                    forecast.find("abbreviatedForecast/iconCode"), "text", None
-                )
-                forecast_dict["iconCode"] = to_int(icon_code)
-                if icon_code:
-                    forecast_dict["iconClass"] = WEATHER_ICONS.get(
-                        icon_code, {}
-                    ).get("name", "we-na")
-                else:
-                    forecast_dict["iconClass"] = "we-na"
-
-                temperature = getattr(
-                    forecast.find("temperatures/temperature"), "text", None
-                )
-                forecast_dict["temperature"] = to_int(temperature)
+def city_gzip(city, language):
+    """Gzip fragment of the serialized city, open for its weather"""
+    return compression.deflate_fragment(city_payload(city, language)[:-1])
+
+
+def city_fragments(city, forecast, language):
+    """
+    Gzip fragments of city_response, None unless the city and its forecast
+    were both compressed ahead of time.
+    """
+    opening = city.get("gzip", {}).get(language)
+    if forecast is None:
+        weather = compression.EMPTY_OBJECT
+    else:
+        weather = forecast.get("gzip")
+    if opening is None or weather is None:
+        return None
+    return [
+        opening,
+        compression.WEATHER_KEY,
+        weather,
+        compression.CLOSE_OBJECT,
+    ]
+
+
+def cities_fragments(cities, language, forecasts):
+    """city_fragments of each city, None unless all of them have some"""
+    fragments = []
+    for city in cities:
+        city_fragment = city_fragments(
+            city, forecasts.get(city["code"]), language
+        )
+        if city_fragment is None:
+            return None
+        fragments.append(city_fragment)
+    return fragments
+
+
+def city_responses(cities, language, forecasts=None):
+    """Serialized response of each city with its forecast"""
+    if forecasts is None:
+        forecasts = find_forecasts(cities, language)
+    return [
+        city_response(
+            c, forecasts.get(c["code"], {}).get("payload"), language
+        )
+        for c in cities
+    ]
+
+
+def batch_cities_query(object_ids, language):
+    """Query and projection of the cities of a batch, without the weather"""
+    other_language = "fr" if language == "en" else "en"
+    return (
+        {"_id": {"$in": list(object_ids.values())}},
+        {
+            "weather": 0,
+            f"payload.{other_language}": 0,
+            f"gzip.{other_language}": 0,
+        },
+    )
 
-                relative_humidity = getattr(
-                    forecast.find("relativeHumidity"), "text", None
-                )
-                forecast_dict["relativeHumidity"] = to_int(relative_humidity)
 
-                precipitation_summary = getattr(
-                    forecast.find("precipitation/textSummary"), "text", None
-                )
-                forecast_dict["precipitationSummary"] = precipitation_summary
-
-                if any([
-                    d in forecast_dict["forecastPeriod"].lower() for d in days
-                ]):
-                    response["longTerm"].append(forecast_dict)
-                else:
-                    response["shortTerm"].append(forecast_dict)
-
-            # Hourly
-            for hourly in root.findall("hourlyForecastGroup/hourlyForecast"):
-                hourly_dict = {}
-                datetime_utc = datetime.datetime.strptime(
-                    hourly.get("dateTimeUTC"), timestamp_format
-                ).replace(tzinfo=pytz.UTC)
-                hourly_dict["datetimeUtc"] = datetime_utc.isoformat()
-                # if hourly_dict["forLocalHour"] == "0":
-                #     hourly_dict["forLocalHour"] = "00"
-
-                condition = getattr(hourly.find("condition"), "text", None)
-                hourly_dict["condition"] = condition
-
-                icon_code = getattr(hourly.find("iconCode"), "text", None)
-                if icon_code:
-                    hourly_dict["iconClass"] = WEATHER_ICONS.get(
-                        icon_code, {}
-                    ).get("name", "we-na")
-                else:
-                    hourly_dict["iconClass"] = "we-na"
-
-                temperature = getattr(hourly.find("temperature"), "text", None)
-                hourly_dict["temperature"] = to_int(temperature)
-
-                humidex = getattr(hourly.find("humidex"), "text", None)
-                hourly_dict["humidex"] = to_int(humidex)
-
-                wind_speed = getattr(hourly.find("wind/speed"), "text", None)
-                hourly_dict["windSpeed"] = to_int(wind_speed)
-
-                wind_direction = getattr(
-                    hourly.find("wind/direction"), "text", None
-                )
-                hourly_dict["windDirection"] = wind_direction
+def batch_response(
+    city_codes, object_ids, found, language, forecasts, fragments=None
+):
+    """
+    JSON array of the cities of a batch in the order they were asked for,
+    with an error entry in place of each unknown city code. Given the
+    cities_fragments of the cities, the array is gzipped out of them.
+    """
+    if fragments is None:
+        parts = city_responses(list(found.values()), language, forecasts)
+    else:
+        parts = fragments
+    responses = dict(zip(found, parts))
+    payloads = []
+    for city_code in city_codes:
+        response = responses.get(object_ids.get(city_code))
+        if response is None:
+            response = to_json(
+                {"id": city_code, "error": "Invalid city code provided"}
+            )
+            if fragments is not None:
+                response = [compression.deflate_fragment(response)]
+        payloads.append(response)
+    if fragments is None:
+        return json_array(payloads)
+    return gzip_array(payloads)
 
-                response["hourly"].append(hourly_dict)
 
-            city[f"weather"][language] = response
+def json_array(payloads):
+    return b"[" + b",".join(payloads) + b"]"
 
-        app.cities_coll.update_one(
-            {'_id': city["_id"]}, {"$set": city}, upsert=False
-        )
 
-        for c in app.cities_coll.find(
-                {"authoritative": False, "code": city["code"]}
-        ):
-            c["weather"] = city["weather"]
-            app.cities_coll.update_one(
-                {'_id': c["_id"]}, {"$set": c}, upsert=False
-            )
+def gzip_array(fragments):
+    """json_array of the gzip fragments of each payload, gzipped"""
+    parts = [compression.OPEN_ARRAY]
+    for position, payload_fragments in enumerate(fragments):
+        if position:
+            parts.append(compression.COMMA)
+        parts.extend(payload_fragments)
+    parts.append(compression.CLOSE_ARRAY)
+    return compression.gzip_member(parts)
+
+
+def to_json(obj):
+    return ujson.dumps(obj, escape_forward_slashes=False).encode()
 
 
 def find_nearest_from_loc(location):
-    station = app.stations_coll.find_one({"loc": {"$near": location}})
+    station = db.stations_coll.find_one({"loc": {"$near": location}})
     if station:
-        return app.cities_coll.find_one(
+        return db.cities_coll.find_one(
             {"stationId": station["_id"], "loc": {"$near": location}}
         )
     return None
 
 
-def to_int(val):
-    try:
-        return int(val)
-    except (ValueError, TypeError):
-        return val
-
-
-def to_float(val, rounding=None):
-    try:
-        if rounding is None:
-            return float(val)
-        if rounding == 0:
-            return round(float(val))
-
-        return round(float(val), rounding)
-    except (ValueError, TypeError):
-        return val
-
-
 def normalize_city(doc, language):
     doc["id"] = str(doc["_id"])
     province_full = f"province{language.capitalize()}"
@@ -360,8 +718,57 @@ def normalize_string(input_str):
     return "".join([c for c in nfkd_form if not unicodedata.combining(c)])
 
 
+def process_city_codes(req):
+    """City codes of ?ids=, comma separated or repeated"""
+    return [
+        city_code
+        for value in req.get_param_as_list("ids") or []
+        for city_code in value.split(",")
+        if city_code
+    ]
+
+
+def to_object_ids(city_codes):
+    """ObjectId of each valid city code"""
+    object_ids = {}
+    for city_code in city_codes:
+        try:
+            object_ids[city_code] = ObjectId(city_code)
+        except InvalidId:
+            pass
+    return object_ids
+
+
+def process_sections(req):
+    """
+    Weather sections asked for with ?sections=current,warnings, None when
+    the whole forecast is wanted. Unknown sections are ignored.
+    """
+    sections = tuple(
+        section
+        for value in req.get_param_as_list("sections") or []
+        for section in value.split(",")
+        if section in WEATHER_SECTIONS
+    )
+    return sections or None
+
+
 def process_language(req):
     language = req.params.get("lang")
     if language not in ["en", "fr"]:
         return "en"
     return language
+
+
+def process_location(req):
+    """
+    (latitude, longitude) of ?lat=&lon=, ValueError unless both are finite
+    and on the globe.
+    """
+    latitude = float(req.params.get("lat"))
+    longitude = float(req.params.get("lon"))
+    if not (math.isfinite(latitude) and math.isfinite(longitude)):
+        raise ValueError("coordinates must be finite")
+    if abs(latitude) > 90 or abs(longitude) > 180:
+        raise ValueError("coordinates out of range")
+    return latitude, longitude